@@ -0,0 +1,129 @@
+'''
+Just enough of discord.py's objects for ModBot's handlers to run without a gateway connection.
+'''
+import itertools
+from types import SimpleNamespace
+import discord
+from bot import ModBot
+
+_ids = itertools.count(10 ** 17)
+
+
+def next_id():
+    return next(_ids)
+
+
+class FakeUser:
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+
+class FakeMessage:
+    def __init__(self, id, content, author, channel):
+        self.id = id
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+
+    async def edit(self, content=None, **kwargs):
+        self.content = content
+        return self
+
+
+class FakeChannel:
+    def __init__(self, id, name, guild, bot_user):
+        self.id = id
+        self.name = name
+        self.guild = guild
+        self.bot_user = bot_user
+        self.messages = {}
+        self.sent = 0
+
+    def add_message(self, message):
+        self.messages[message.id] = message
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+        message = FakeMessage(next_id(), content, self.bot_user, self)
+        self.messages[message.id] = message
+        return message
+
+    def get_partial_message(self, id):
+        return self.messages[id]
+
+    async def fetch_message(self, id):
+        if id not in self.messages:
+            raise discord.errors.NotFound(SimpleNamespace(status=404, reason='Not Found'), 'Unknown Message')
+        return self.messages[id]
+
+
+class FakeDMChannel(FakeChannel):
+    def __init__(self, bot_user):
+        super().__init__(next_id(), None, None, bot_user)
+        self.replies = []
+
+    async def send(self, content=None, **kwargs):
+        self.replies.append(content)
+        return await super().send(content, **kwargs)
+
+
+class FakeGuild:
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+        self.text_channels = []
+
+    def get_channel(self, id):
+        for channel in self.text_channels:
+            if channel.id == id:
+                return channel
+        return None
+
+
+class ReplayBot(ModBot):
+    '''
+    ModBot wired to a single fake guild with the usual `group-N` and `group-N-mod` channels.
+    '''
+
+    def __init__(self, *args, group_num='0', **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fake_user = FakeUser(next_id(), f'Group {group_num} Bot')
+        self.guild = FakeGuild(next_id(), 'Replay Guild')
+        self.main_channel = FakeChannel(next_id(), f'group-{group_num}', self.guild, self.fake_user)
+        self.mod_channel = FakeChannel(next_id(), f'group-{group_num}-mod', self.guild, self.fake_user)
+        self.guild.text_channels = [self.main_channel, self.mod_channel]
+        self.flag_posts = {}  # Flagged message id -> id of the mod post about it
+
+    def track_flag(self, record, mod_message_id, scores=None):
+        super().track_flag(record, mod_message_id, scores)
+        self.flag_posts[record.message_id] = mod_message_id
+
+    @property
+    def user(self):
+        return self.fake_user
+
+    @property
+    def guilds(self):
+        return [self.guild]
+
+    def get_guild(self, id):
+        return self.guild if id == self.guild.id else None
+
+    def get_channel(self, id):
+        return self.guild.get_channel(id)
+
+
+def reaction_payload(bot, mod_message_id, emoji, user_id):
+    return SimpleNamespace(guild_id=bot.guild.id, channel_id=bot.mod_channel.id, message_id=mod_message_id,
+                           user_id=user_id, emoji=SimpleNamespace(name=emoji), event_type='REACTION_ADD')
+
+
+def edit_payload(bot, message, before=None):
+    # Raw gateway payloads carry ids as strings. `before` is the content discord.py's message cache would have.
+    cached_message = SimpleNamespace(content=before) if before is not None else None
+    return SimpleNamespace(message_id=message.id, channel_id=bot.main_channel.id, cached_message=cached_message,
+                           data={'id': str(message.id), 'channel_id': str(bot.main_channel.id),
+                                 'guild_id': str(bot.guild.id), 'content': message.content,
+                                 'author': {'id': str(message.author.id), 'username': message.author.name}})
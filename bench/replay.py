@@ -0,0 +1,256 @@
+'''
+Replays a recorded JSONL corpus of Discord events through ModBot with a fake client/channel layer
+and a local Perspective stand-in, then reports throughput, handler latency and peak memory.
+
+    python -m bench.replay bench/corpus.jsonl --latency 0.08 --error-rate 0.02
+    python -m bench.replay --synthetic 5000 --qps 200
+
+Each corpus line is one event. Message ids are corpus-local names:
+    {"type": "message", "id": "m1", "author": "alice", "content": "hello"}
+    {"type": "edit", "id": "m1", "content": "hello there"}
+    {"type": "react", "id": "m1", "emoji": "💩"}       (reaction on the mod post for m1)
+    {"type": "dm", "author": "bob", "content": "{link:m1}"}
+'''
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import statistics
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+import resources
+from bench.fakes import FakeDMChannel, FakeMessage, FakeUser, ReplayBot, edit_payload, next_id, reaction_payload
+from bench.stub_perspective import StubPerspective
+from scheduler import TokenBucket
+from telemetry import REGISTRY
+
+LINK = re.compile(r'\{link:([^}]+)\}')
+
+BENIGN = ['ok', 'lol', 'anyone up for a game tonight?', 'what time is the meeting', 'thanks!',
+          'did you see the new episode', 'brb', 'that was a great match', 'good morning everyone']
+TOXIC = ['you are such an idiot', 'nobody likes you, loser', 'i hate people like you', 'this is trash and so are you']
+FLIRTY = ['you are so cute, want to go on a date?', 'send me some pics, it will be our secret']
+
+
+def synthetic_corpus(n, seed=0):
+    '''
+    A raid-ish mix: mostly small talk, repeated spam, some toxic/flirty messages, edits, reactions and a few report flows.
+    '''
+    rng = random.Random(seed)
+    authors = [f'user{i}' for i in range(max(n // 20, 5))]
+    events = []
+    for i in range(n):
+        msg_id = f'm{i}'
+        roll = rng.random()
+        if roll < 0.55:
+            content = rng.choice(BENIGN)
+        elif roll < 0.75:
+            content = 'FREE NITRO at spam.example ' + ' ' * rng.randint(0, 3)
+        elif roll < 0.9:
+            content = rng.choice(TOXIC)
+        else:
+            content = rng.choice(FLIRTY)
+        events.append({'type': 'message', 'id': msg_id, 'author': rng.choice(authors), 'content': content})
+        if rng.random() < 0.1:
+            # Half of these are no-op updates like an embed unfurling; some come in bursts of quick fixes
+            for n in range(1 + (rng.random() < 0.3) * 2):
+                events.append({'type': 'edit', 'id': msg_id,
+                               'content': content + (' (edited)' * (n + 1) if rng.random() < 0.5 else '')})
+        if roll >= 0.75 and rng.random() < 0.3:
+            emoji = rng.choice([resources.DEL_MSG_EMOJI, resources.BAN_USER_EMOJI, resources.RESOLVED_NO_ACTION, '👍'])
+            events.append({'type': 'react', 'id': msg_id, 'emoji': emoji})
+        if roll >= 0.9 and rng.random() < 0.2:
+            reporter = rng.choice(authors)
+            for content in ('report', f'{{link:{msg_id}}}', resources.INTIMATE_KEYWORD,
+                            rng.choice([resources.UNDERAGE_KEYWORD, resources.OVERAGE_KEYWORD])):
+                events.append({'type': 'dm', 'author': reporter, 'content': content})
+    return events
+
+
+def load_corpus(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+class Replayer:
+    def __init__(self, bot, rate=None):
+        self.bot = bot
+        self.rate = rate
+        self.users = {}
+        self.dm_channels = {}
+        self.messages = {}  # corpus id -> FakeMessage
+        self.latencies = defaultdict(list)
+        self.skipped = 0
+        self.failures = 0
+        self.moderator = FakeUser(next_id(), 'moderator')
+        self.tasks = []
+        self.reactions = []
+        self.drained = asyncio.Event()
+
+    def user(self, name):
+        if name not in self.users:
+            self.users[name] = FakeUser(next_id(), name)
+        return self.users[name]
+
+    async def timed(self, kind, coro):
+        start = time.perf_counter()
+        try:
+            await coro
+        except Exception:
+            self.failures += 1
+            logging.getLogger('discord').exception(f'{kind} handler failed')
+        self.latencies[kind].append(time.perf_counter() - start)
+
+    async def event(self, event):
+        bot = self.bot
+        kind = event['type']
+        if kind == 'message':
+            message = FakeMessage(next_id(), event['content'], self.user(event['author']), bot.main_channel)
+            bot.main_channel.add_message(message)
+            self.messages[event['id']] = message
+            return self.timed('on_message', bot.on_message(message))
+        if kind == 'edit':
+            message = self.messages.get(event['id'])
+            if message is None:
+                return None
+            before = message.content
+            message.content = event['content']
+            return self.timed('on_raw_message_edit', bot.on_raw_message_edit(edit_payload(bot, message, before)))
+        if kind == 'react':
+            message = self.messages.get(event['id'])
+            if message is None:
+                return None
+            self.reactions.append(asyncio.ensure_future(self.react(message, event['emoji'])))
+            return None
+        if kind == 'dm':
+            author = self.user(event['author'])
+            channel = self.dm_channels.setdefault(author.id, FakeDMChannel(bot.fake_user))
+            content = LINK.sub(lambda m: self.link(m.group(1)), event['content'])
+            message = FakeMessage(next_id(), content, author, channel)
+            # A user's DMs are handled in order, like a person typing them one after another
+            return self.timed('dm', bot.on_message(message))
+        raise ValueError(f'Unknown event type {kind!r}')
+
+    async def react(self, message, emoji):
+        # A moderator can only react once the flag has been posted, which may still be waiting on Perspective
+        while message.id not in self.bot.flag_posts and not self.drained.is_set():
+            await asyncio.sleep(0.05)
+        if message.id not in self.bot.flag_posts:
+            self.skipped += 1
+            return
+        payload = reaction_payload(self.bot, self.bot.flag_posts[message.id], emoji, self.moderator.id)
+        await self.timed('on_raw_reaction_add', self.bot.on_raw_reaction_add(payload))
+
+    def link(self, corpus_id):
+        message = self.messages.get(corpus_id)
+        if message is None:
+            return 'https://discord.com/channels/0/0/0'
+        return f'https://discord.com/channels/{self.bot.guild.id}/{self.bot.main_channel.id}/{message.id}'
+
+    async def run(self, events):
+        start = time.perf_counter()
+        for i, event in enumerate(events):
+            if self.rate:
+                delay = start + i / self.rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            coro = await self.event(event)
+            if coro is None:
+                continue
+            if event['type'] == 'dm':
+                await coro
+            else:
+                # discord.py dispatches every gateway event as its own task
+                self.tasks.append(asyncio.ensure_future(coro))
+        await asyncio.gather(*self.tasks)
+        dispatched = time.perf_counter() - start
+        await self.bot.edits.join()
+        await self.bot.scheduler.queue.join()
+        await self.bot.outbox.join()
+        self.drained.set()
+        await asyncio.gather(*self.reactions)
+        return dispatched, time.perf_counter() - start
+
+
+async def bench(args):
+    if not args.verbose:
+        logging.getLogger('discord').setLevel(logging.CRITICAL)
+    events = load_corpus(args.corpus) if args.corpus else synthetic_corpus(args.synthetic, args.seed)
+
+    stub = StubPerspective(args.latency, args.jitter, args.error_rate)
+    url = await stub.start()
+    tmp = tempfile.TemporaryDirectory()
+    tracemalloc.start()
+    bot = ReplayBot('bench-key', perspective_url=url, db_path=os.path.join(tmp.name, 'moderation.db'),
+                    score_cache_path=None)
+    bot.perspective.rate_limiter = TokenBucket(args.qps, args.qps)
+    bot.outbox.rate = bot.outbox.burst = args.post_rate
+    bot.edits.delay = args.edit_delay
+    await bot.on_ready()
+
+    replayer = Replayer(bot, args.rate)
+    dispatched, elapsed = await replayer.run(events)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f'events:              {len(events)}')
+    print(f'dispatch time:       {dispatched:.3f}s')
+    print(f'total time (drained): {elapsed:.3f}s')
+    print(f'throughput:          {len(events) / elapsed:.1f} events/s')
+    for kind, values in sorted(replayer.latencies.items()):
+        ms = [v * 1000 for v in values]
+        print(f'{kind:20} n={len(ms):<6} p50={percentile(ms, 50):8.3f}ms p99={percentile(ms, 99):8.3f}ms '
+              f'mean={statistics.mean(ms):8.3f}ms')
+    print(f'peak memory:         {peak / 1024 / 1024:.2f} MiB')
+    print(f'perspective calls:   {stub.requests} ({stub.errors} errors injected)')
+    print(f'mod channel posts:   {bot.mod_channel.sent}')
+    print(f'skipped reactions:   {replayer.skipped}')
+    print(f'handler failures:    {replayer.failures}')
+    print(f'scheduler:           {bot.scheduler.stats()}')
+    print(f'prefilter:           {bot.prefilter.stats()}')
+    print(f'score cache:         {bot.score_cache.stats()}')
+    print(f'outbox:              {bot.outbox.stats()}')
+    print(f'edits:               {bot.edits.stats()}')
+    print(f'risk:                {bot.risk.stats()}')
+    if args.metrics:
+        print(REGISTRY.render())
+
+    await bot.close()
+    await stub.stop()
+    tmp.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('corpus', nargs='?', help='JSONL corpus to replay')
+    parser.add_argument('--synthetic', type=int, default=1000,
+                        help='number of synthetic messages to generate when no corpus is given')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rate', type=float, default=None, help='events per second (default: as fast as possible)')
+    parser.add_argument('--qps', type=float, default=100.0, help='token bucket rate for Perspective calls')
+    parser.add_argument('--post-rate', type=float, default=1000.0,
+                        help='posts per second per channel (Discord allows about 1, with bursts of 5)')
+    parser.add_argument('--edit-delay', type=float, default=0.2, help='seconds an edited message must be left alone '
+                        'before it is re-scored')
+    parser.add_argument('--latency', type=float, default=0.05, help='mean stub Perspective latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of stub requests answered with 429/503')
+    parser.add_argument('--metrics', action='store_true', help='print the Prometheus metrics at the end')
+    parser.add_argument('--verbose', action='store_true', help='show the bot\'s log output')
+    asyncio.run(bench(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
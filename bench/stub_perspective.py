@@ -0,0 +1,88 @@
+'''
+Local stand-in for the Perspective API with configurable latency and error rate.
+
+    python -m bench.stub_perspective --port 8080 --latency 0.08 --error-rate 0.02
+'''
+import argparse
+import asyncio
+import hashlib
+import random
+from aiohttp import web
+
+TOXIC_WORDS = ('idiot', 'stupid', 'hate', 'kill', 'loser', 'trash')
+FLIRTY_WORDS = ('cute', 'date', 'sexy', 'pics', 'secret')
+
+
+def fake_scores(text, attributes):
+    '''
+    Deterministic scores: low noise derived from the text, pushed up by a few trigger words.
+    '''
+    lowered = text.lower()
+    noise = int(hashlib.md5(text.encode('utf-8')).hexdigest()[:4], 16) / 0xffff * 0.3
+    scores = {}
+    for attr in attributes:
+        value = noise
+        if attr == 'FLIRTATION':
+            if any(w in lowered for w in FLIRTY_WORDS):
+                value = 0.85
+        elif any(w in lowered for w in TOXIC_WORDS):
+            value = 0.9 if attr in ('TOXICITY', 'PROFANITY') else 0.6
+        scores[attr] = {'summaryScore': {'value': value, 'type': 'PROBABILITY'}}
+    return scores
+
+
+class StubPerspective:
+    def __init__(self, latency=0.05, jitter=0.02, error_rate=0.0, port=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.port = port
+        self.requests = 0
+        self.errors = 0
+        self._runner = None
+
+    async def analyze(self, request):
+        self.requests += 1
+        await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        if random.random() < self.error_rate:
+            self.errors += 1
+            status = random.choice((429, 503))
+            return web.json_response({'error': {'code': status}}, status=status)
+        body = await request.json()
+        attributes = list(body.get('requestedAttributes', {}))
+        return web.json_response({'attributeScores': fake_scores(body['comment']['text'], attributes)})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/v1alpha1/comments:analyze', self.analyze)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', self.port)
+        await site.start()
+        # Pick up the real port if we asked for any free one
+        self.port = self._runner.addresses[0][1]
+        return f'http://127.0.0.1:{self.port}/v1alpha1/comments:analyze'
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+async def serve(args):
+    stub = StubPerspective(args.latency, args.jitter, args.error_rate, args.port)
+    url = await stub.start()
+    print(f'Stub Perspective listening on {url}')
+    while True:
+        await asyncio.sleep(3600)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.05, help='mean response time in seconds')
+    parser.add_argument('--jitter', type=float, default=0.02, help='standard deviation of the response time')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 429/503')
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
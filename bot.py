@@ -1,49 +1,119 @@
 # bot.py
+import argparse
+import asyncio
 import discord
-from discord.ext import commands
+import multiprocessing
 from datetime import datetime
 import os
 import json
 import logging
 import re
-import requests
+import time
 import resources
-from report import Report
+from cache import ScoreCache, content_key
+from db import ModerationDB
+from edits import EditDebouncer, EditedMessage
+from flagging import flag_post, flagged_attributes, pattern_post, report_post
+from outbox import FLAG, NOTICE, REPORT, URGENT, Outbox
+from perspective import PERSPECTIVE_URL, PerspectiveClient
+from prefilter import PreFilter
+from scheduler import ClassificationScheduler, TokenBucket
+from report import Report, ReportSessions, State
+from risk import RiskAggregator
+from store import BoundedStore, FlagRecord, ModPostRecord
+from workers import WorkerPool
+from telemetry import (DECISION_SECONDS, FLAGS_RAISED, ON_MESSAGE_SECONDS, REGISTRY, RISK_ESCALATIONS,
+                       SCORE_SOURCES, MetricsExporter, setup_queue_logging)
 
-# Set up logging to the console
 logger = logging.getLogger('discord')
-logger.setLevel(logging.DEBUG)
-handler = logging.FileHandler(
-    filename='discord.log', encoding='utf-8', mode='w')
-handler.setFormatter(logging.Formatter(
-    '%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-logger.addHandler(handler)
-
-# There should be a file called 'token.json' inside the same folder as this file
-token_path = 'tokens.json'
-if not os.path.isfile(token_path):
-    raise Exception(f"{token_path} not found!")
-with open(token_path) as f:
-    # If you get an error here, it means your token is formatted incorrectly. Did you put it in quotes?
-    tokens = json.load(f)
-    discord_token = tokens['discord']
-    perspective_key = tokens['perspective']
+
+
+def setup_logging(filename='discord.log'):
+    # Log to discord.log from a background thread; gateway DEBUG chatter is sampled
+    handler = logging.FileHandler(
+        filename=filename, encoding='utf-8', mode='w')
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
+    return setup_queue_logging(handler)
+
+
+def load_tokens(token_path='tokens.json'):
+    # There should be a file called 'token.json' inside the same folder as this file
+    if not os.path.isfile(token_path):
+        raise Exception(f"{token_path} not found!")
+    with open(token_path) as f:
+        # If you get an error here, it means your token is formatted incorrectly. Did you put it in quotes?
+        tokens = json.load(f)
+        return tokens['discord'], tokens['perspective']
 
 
 class ModBot(discord.Client):
 
-    def __init__(self, key):
+    def __init__(self, key, perspective_url=PERSPECTIVE_URL, db_path='moderation.db',
+                 score_cache_path='score_cache.json', metrics_port=None, metrics_path=None,
+                 classification_workers=0, reports_channel_id=None, perspective_qps=1.0, **options):
         intents = discord.Intents.default()
-        super().__init__(command_prefix='.', intents=intents)
+        # options carries the shard settings (shard_id/shard_ids and shard_count) when running sharded
+        super().__init__(command_prefix='.', intents=intents, **options)
         self.group_num = None
-        self.mod_channels = {}  # Map from guild to the mod channel id for that guild
-        self.reports = {}  # Map from user IDs to the state of their report
-        # Track the status of automatic flagging based on moderators' judgement
-        self.automatic_flag_reports = {}
-        self.mod_channel_messages = {}
+        # Where to listen and where to post in each guild. These are filled in as guilds become available
+        # and kept up to date from channel events, so handlers only do id lookups.
+        self.main_channels = {}  # Map from guild id to that guild's group-N channel
+        self.mod_channels = {}  # Map from guild id to that guild's group-N-mod channel
+        self.main_channel_ids = set()
+        self.mod_channel_ids = set()
+        self.indexed_guilds = set()
+        self.reports = ReportSessions(self)  # Map from user IDs to the state of their report
+        # Track the status of automatic flags and user reports based on moderators' judgement. Both stores
+        # keep compact records rather than discord.Message objects and are capped in size and age.
+        # mod_channel_messages maps each of our mod-channel posts to the flag it is about.
+        self.automatic_flag_reports = BoundedStore(
+            max_entries=10000, max_bytes=16 * 1024 * 1024, loader=self.rehydrate_flag)
+        self.mod_channel_messages = BoundedStore(
+            max_entries=10000, loader=self.rehydrate_mod_post)
+        # Durable copy of the above plus user reports and moderator decisions, so a restart loses nothing
+        self.db = ModerationDB(db_path)
+        self.warm_stores()
+        # Where user-submitted reports are posted; by default the mod channel of the reported message's guild
+        self.reports_channel_id = reports_channel_id
         self.perspective_key = key
         self.tox_threshold = 0.5
         self.flirt_threshold = 0.7
+        # Rolling scores per author and channel, so a run of borderline messages gets flagged as a whole
+        self.risk = RiskAggregator()
+        # This process's share of the Perspective quota (the default quota is 1 QPS). The quota is per
+        # project, so when several gateway processes share a key each one gets its slice of it.
+        self.perspective_qps = perspective_qps
+        self.perspective = PerspectiveClient(
+            key, url=perspective_url, rate_limiter=TokenBucket(self.perspective_qps))
+        # Local first stage that settles obvious cases without calling Perspective
+        self.prefilter = PreFilter()
+        # Scores of recently seen content, so spam raids and no-op edits don't cost an API call
+        self.score_cache = ScoreCache(path=score_cache_path)
+        self.score_cache.load()
+        self.pending_scores = {}  # Content key -> in-flight Perspective call for that content
+        self.scheduler = ClassificationScheduler(self.eval_text, self.handle_scores)
+        # Edited messages are re-scored once the edits stop, and only if the text actually changed
+        self.edits = EditDebouncer(self.handle_channel_message)
+        # With classification_workers > 0, scoring and flag posting happen in separate processes instead
+        self.worker_pool = None
+        if classification_workers:
+            self.worker_pool = WorkerPool(
+                classification_workers, key, self.handle_worker_scores, perspective_url=perspective_url,
+                qps=self.perspective_qps, tox_threshold=self.tox_threshold, flirt_threshold=self.flirt_threshold,
+                risk_floor=self.risk.floor)
+        # Posts to the mod channels are queued and sent in the background, most urgent first
+        self.outbox = Outbox()
+        self.metrics = MetricsExporter(port=metrics_port, dump_path=metrics_path)
+        REGISTRY.gauge('modbot_report_sessions', 'Active user report sessions by state', self.report_session_counts)
+        REGISTRY.gauge('modbot_classification_queue_depth', 'Messages waiting to be scored',
+                       lambda: self.scheduler.queue.qsize())
+        REGISTRY.gauge('modbot_classification_in_flight', 'Messages being scored right now',
+                       lambda: len(self.scheduler._in_flight))
+        REGISTRY.gauge('modbot_score_cache_entries', 'Entries in the score cache', lambda: len(self.score_cache))
+        REGISTRY.gauge('modbot_outbox_queued', 'Posts waiting to be sent to the mod channels', lambda: len(self.outbox))
+        REGISTRY.gauge('modbot_risk_authors', 'Authors with a rolling risk window', lambda: len(self.risk))
+        REGISTRY.gauge('modbot_pending_flags', 'Flags waiting for a moderator', lambda: len(self.automatic_flag_reports))
 
     async def on_ready(self):
         print(f'{self.user.name} has connected to Discord! It is these guilds:')
@@ -51,19 +121,82 @@ class ModBot(discord.Client):
             print(f' - {guild.name}')
         print('Press Ctrl-C to quit.')
 
+        self.resolve_group_num()
+
+        await self.metrics.start()
+        if self.worker_pool is not None:
+            self.worker_pool.start(self.http.token)
+
+        # Guilds normally get indexed as they become available; this catches any that were missed
+        for guild in self.guilds:
+            if guild.id not in self.indexed_guilds:
+                self.index_guild(guild)
+
+    def resolve_group_num(self):
         # Parse the group number out of the bot's name
+        if self.group_num is not None:
+            return self.group_num
         match = re.search('[gG]roup (\d+) [bB]ot', self.user.name)
         if match:
             self.group_num = match.group(1)
         else:
             raise Exception(
                 "Group number not found in bot's name. Name format should be \"Group # Bot\".")
+        return self.group_num
 
-        # Find the mod channel in each guild that this bot should report to
-        for guild in self.guilds:
-            for channel in guild.text_channels:
-                if channel.name == f'group-{self.group_num}-mod':
-                    self.mod_channels[guild.id] = channel
+    def index_guild(self, guild):
+        self.indexed_guilds.add(guild.id)
+        for channel in guild.text_channels:
+            self.index_channel(channel)
+
+    def unindex_guild(self, guild):
+        self.indexed_guilds.discard(guild.id)
+        for channels, ids in ((self.main_channels, self.main_channel_ids), (self.mod_channels, self.mod_channel_ids)):
+            channel = channels.pop(guild.id, None)
+            if channel is not None:
+                ids.discard(channel.id)
+
+    def index_channel(self, channel):
+        group_num = self.resolve_group_num()
+        if channel.name == f'group-{group_num}':
+            channels, ids = self.main_channels, self.main_channel_ids
+        elif channel.name == f'group-{group_num}-mod':
+            channels, ids = self.mod_channels, self.mod_channel_ids
+        else:
+            return
+        previous = channels.get(channel.guild.id)
+        if previous is not None:
+            ids.discard(previous.id)
+        channels[channel.guild.id] = channel
+        ids.add(channel.id)
+
+    def unindex_channel(self, channel):
+        for channels, ids in ((self.main_channels, self.main_channel_ids), (self.mod_channels, self.mod_channel_ids)):
+            if channel.id in ids:
+                ids.discard(channel.id)
+                channels.pop(channel.guild.id, None)
+
+    async def on_guild_available(self, guild):
+        self.index_guild(guild)
+
+    async def on_guild_join(self, guild):
+        self.index_guild(guild)
+
+    async def on_guild_remove(self, guild):
+        self.unindex_guild(guild)
+
+    async def on_guild_channel_create(self, channel):
+        if isinstance(channel, discord.TextChannel):
+            self.index_channel(channel)
+
+    async def on_guild_channel_update(self, before, after):
+        # Renames can move a channel in or out of our routing
+        if isinstance(after, discord.TextChannel) and before.name != after.name:
+            self.unindex_channel(before)
+            self.index_channel(after)
+
+    async def on_guild_channel_delete(self, channel):
+        self.unindex_channel(channel)
 
     async def on_message(self, message):
         '''
@@ -72,17 +205,17 @@ class ModBot(discord.Client):
         '''
         # Ignore messages from us
         if message.author.id == self.user.id:
-            if message.guild and message.channel.name == f'group-{self.group_num}-mod':
-                self.mod_channel_messages[message.id] = message
             return
 
         # Check if this message was sent in a server ("guild") or if it's a DM
 
         if message.guild:
-            if message.channel.name == f'group-{self.group_num}':
-                await self.handle_channel_message(message)
+            if message.channel.id in self.main_channel_ids:
+                with ON_MESSAGE_SECONDS.time(kind='channel'):
+                    await self.handle_channel_message(message)
         else:
-            await self.handle_dm(message)
+            with ON_MESSAGE_SECONDS.time(kind='dm'):
+                await self.handle_dm(message)
 
     async def handle_dm(self, message):
         # Handle a help message
@@ -96,138 +229,421 @@ class ModBot(discord.Client):
         responses = []
 
         # Only respond to messages if they're part of a reporting flow
-        if author_id not in self.reports and not message.content.startswith(Report.START_KEYWORD):
+        report = self.reports.get(author_id)
+        if report is None and not message.content.startswith(Report.START_KEYWORD):
             return
 
         # If we don't currently have an active report for this user, add one
-        if author_id not in self.reports:
-            self.reports[author_id] = Report(self)
+        if report is None:
+            report = self.reports.start(author_id)
+            if report is None:
+                await message.channel.send("We are handling a lot of reports right now. Please try again in a few minutes.")
+                return
 
         # Let the report class handle this message; forward all the messages it returns to uss
-        responses = await self.reports[author_id].handle_message(message)
+        previous_state = report.state
+        responses = await report.handle_message(message)
         for r in responses:
             await message.channel.send(r)
 
         # If the report is complete or cancelled, remove it from our map
-        if self.reports[author_id].report_complete():
+        if report.report_complete():
             self.reports.pop(author_id)
+            return
 
         # handel message submision from the dm channel
-        if self.reports[author_id].report_submitted():
-            CID = 802408308471496744
-            channel = client.get_channel(CID)
-            await channel.send(f'**Suspected message:**\n**Suspected abuser:** {Report.reported_message.author.name} \n**Message ID:**__`#{Report.reported_message.id}#`__ **Message Content:** `{Report.reported_message.content}`'+'\n' +
-                               '**Message report type:**`{Report.type}`' + '\n'+'Please use one of the following reactions:' +
-                               '\n\n'+resources.DEL_MSG_EMOJI+' `Delete` the reported message'
-                               + '\n\n'+resources.BAN_USER_EMOJI+' `Ban` the reported user'
-                               + '\n\n'+resources.REPORT_AND_BAN_EMOJI +
-                               ' `Ban` the reported user and `Escalate` this incident to local authorities'
-                               + '\n\n'+resources.RESOLVED_NO_ACTION +
-                               ' Mark this report as `Resolved` with no further actions'
-                               + '\n\n'+'Select any other reaction to mark the report as false alarm')
-
-        # Forward and flag POTENTIAL_CHILD_SOLICITATION reports
-        if self.reports[author_id].child_solicitation():
-            CID = 802408308471496744
-            channel = client.get_channel(CID)
-            await channel.send(f'🚨🚨🚨🚨🚨🚨🚨🚨🚨\n'+'🚨🚨   **High Priority**   🚨🚨\n'+'🚨🚨🚨🚨🚨🚨🚨🚨🚨\n\n\n' + '**POTENTIAL_CHILD_SOLICITATION**\n\n'
-                               '**Suspected message:**\n**Suspected abuser:** {Report.reported_message.author.name} \n**Message ID:**__`#{Report.reported_message.id}#`__ **Message Content:** `{Report.reported_message.content}`'+'\n' +
-                               '**Message report type:**`{Report.type}`' + '\n'+'Please use one of the following reactions:' +
-                               '\n\n'+resources.DEL_MSG_EMOJI+' `Delete` the reported message'
-                               + '\n\n'+resources.BAN_USER_EMOJI+' `Ban` the reported user'
-                               + '\n\n'+resources.REPORT_AND_BAN_EMOJI +
-                               ' `Ban` the reported user and `Escalate` this incident to local authorities'
-                               + '\n\n'+resources.RESOLVED_NO_ACTION +
-                               ' Mark this report as `Resolved` with no further actions'
-                               + '\n\n'+'Select any other reaction to mark the report as false alarm')
+        if report.report_submitted():
+            self.reports.pop(author_id)
+            record = FlagRecord.from_message(report.reported_message)
+            self.db.add_report(record, author_id, report.type)
+            channel = await self.reports_channel(report)
+            if channel is None:
+                return
+            posted = self.outbox.post(channel, report_post(report.reported_message.author.name, report.reported_message.id,
+                                                           report.reported_message.content, report.type),
+                                      REPORT, on_sent=lambda mod_message: self.track_report(record, mod_message.id))
+            if not posted:
+                # The outbox never refuses reports, but if it ever does the report must not vanish silently
+                logger.error(f'Could not queue the report about message {report.reported_message.id} for the mod channel')
+
+        # Forward and flag POTENTIAL_CHILD_SOLICITATION reports. The session stays open (until it expires)
+        # so the reporter keeps getting the resources, but the mod channel only hears about it once.
+        if report.child_solicitation() and previous_state != State.POTENTIAL_CHILD_SOLICITATION:
+            record = FlagRecord.from_message(report.reported_message)
+            self.db.add_report(record, author_id, report.type, child_solicitation=True)
+            channel = await self.reports_channel(report)
+            if channel is None:
+                return
+            posted = self.outbox.post(channel, report_post(report.reported_message.author.name, report.reported_message.id,
+                                                           report.reported_message.content, report.type,
+                                                           child_solicitation=True),
+                                      URGENT, on_sent=lambda mod_message: self.track_report(record, mod_message.id))
+            if not posted:
+                logger.error(f'Could not queue the report about message {report.reported_message.id} for the mod channel')
+
+    async def reports_channel(self, report):
+        '''
+        Where to post a report. With several gateway processes every DM arrives at the one running shard 0,
+        so the reported guild (or the reports channel) may not be in our cache; those are looked up over REST.
+        Reactions to the post reach the process that owns the guild, which finds it in the shared database.
+        '''
+        if self.reports_channel_id is not None:
+            channel = self.get_channel(self.reports_channel_id)
+            if channel is None:
+                try:
+                    channel = await self.fetch_channel(self.reports_channel_id)
+                except discord.HTTPException as e:
+                    logger.error(f'Could not fetch the reports channel {self.reports_channel_id}: {e}')
+            return channel
+        guild = report.reported_message.guild
+        channel = self.mod_channels.get(guild.id)
+        if channel is None and guild.id not in self.indexed_guilds:
+            channel = await self.fetch_mod_channel(guild)
+        if channel is None:
+            logger.error(f'No mod channel to post the report about message {report.reported_message.id} to')
+        return channel
+
+    async def fetch_mod_channel(self, guild):
+        # For guilds owned by another gateway process; reports are rare enough to look it up each time
+        name = f'group-{self.resolve_group_num()}-mod'
+        try:
+            channels = await guild.fetch_channels()
+        except discord.HTTPException as e:
+            logger.error(f'Could not fetch the channels of guild {guild.id}: {e}')
+            return None
+        for channel in channels:
+            if isinstance(channel, discord.TextChannel) and channel.name == name:
+                return channel
+        return None
 
     async def handle_channel_message(self, message):
+        mod_channel = self.mod_channels.get(message.guild.id)
+        if mod_channel is None:
+            # Nowhere to flag it to (e.g. the mod channel was deleted), so don't pay for scoring it
+            return
+        # Edits of a message we already flagged are scored here so that the existing post can be updated
+        flag = self.automatic_flag_reports.get(message.id)
+        if self.worker_pool is not None and (flag is None or flag.mod_message_id is None):
+            if not self.worker_pool.submit(message, mod_channel.id):
+                logger.warning(f'Classification workers are backed up, dropped message {message.id}')
+            return
+
+        scores = self.prefilter.classify(message.content)
+        source = 'prefilter'
+        if scores is None:
+            scores = self.score_cache.get(message.content)
+            source = 'cache'
+        if scores is not None:
+            SCORE_SOURCES.inc(source=source)
+            await self.handle_scores(message, scores)
+            return
+
+        # Queue the message for scoring; handle_scores is called once Perspective has answered
+        if not await self.scheduler.submit(message):
+            logger.warning(f'Classification queue is full, dropped message {message.id}')
+
+    async def handle_scores(self, message, scores):
         # Forward the message to the mod channel
-        mod_channel = self.mod_channels[message.guild.id]
-        scores = self.eval_text(message)
-
-        tmp = [scores[k] for k in scores if k != 'FLIRTATION']
-        if max(tmp) > self.tox_threshold or scores['FLIRTATION'] > self.flirt_threshold:
-            self.automatic_flag_reports[message.id] = message
-            await mod_channel.send(f'**Suspected message:**\n**Suspected abuser:** {message.author.name} \n**Message ID:**__`#{message.id}#`__ **Message Content:** `{message.content}`'+'\n' +
-                                   '**Message Suspicion Score:**\n'+self.code_format(json.dumps(
-                                       scores, indent=2))+'\n'+'Please use one of the following reactions:'+'\n\n'+resources.DEL_MSG_EMOJI+' `Delete` the reported message'
-                                   + '\n\n'+resources.BAN_USER_EMOJI+' `Ban` the reported user'
-                                   + '\n\n'+resources.REPORT_AND_BAN_EMOJI +
-                                   ' `Ban` the reported user and `Escalate` this incident to local authorities'
-                                   + '\n\n'+resources.RESOLVED_NO_ACTION +
-                                   ' Mark this report as `Resolved` with no further actions'
-                                   + '\n\n'+'Select any other reaction to mark the report as false alarm')
+        mod_channel = self.mod_channels.get(message.guild.id)
+        if mod_channel is None:
+            # The mod channel went away while the message was being scored
+            return
+        flag = self.automatic_flag_reports.get(message.id)
+        if flag is not None and flag.mod_message_id is not None:
+            # The message was edited after we flagged it; show the new text on the same post
+            self.update_flag(message, scores, flag, mod_channel)
+            return
+        attributes = flagged_attributes(scores, self.tox_threshold, self.flirt_threshold)
+        if attributes:
+            for attr in attributes:
+                FLAGS_RAISED.inc(attribute=attr)
+            record = FlagRecord.from_message(message)
+
+            def on_sent(mod_message):
+                record.mod_message_id = mod_message.id
+                self.track_flag(record, mod_message.id, scores)
+            self.outbox.post(mod_channel, flag_post(message.author.name, message.id, message.content, scores), FLAG,
+                             on_sent=on_sent)
+        # Flagged messages count towards the author's trend too; if one tips it over, its own flag stands in
+        # for the consolidated one
+        escalation = self.risk.observe(message.channel.id, message.author.id, message.id, scores)
+        if escalation is not None and not attributes:
+            self.escalate(FlagRecord.from_message(message), message.content, escalation, mod_channel)
+
+    def escalate(self, record, content, escalation, mod_channel):
+        risk, triggered = escalation
+        for attr in triggered:
+            RISK_ESCALATIONS.inc(attribute=attr)
+        # Only the messages behind the escalation, not the small talk in between
+        message_ids = self.risk.recent_message_ids(record.channel_id, record.author_id, triggered)
+        # The record deliberately has no mod_message_id: the post is about the whole run of messages,
+        # so a later edit of the latest one must not rewrite it as a single-message flag
+        self.outbox.post(mod_channel, pattern_post(record.author_name, record.message_id, content, message_ids, risk),
+                         REPORT, on_sent=lambda mod_message: self.track_flag(record, mod_message.id, risk))
+
+    def update_flag(self, message, scores, flag, mod_channel):
+        record = FlagRecord.from_message(message)
+        record.created_at = flag.created_at
+        record.mod_message_id = flag.mod_message_id
+        self.automatic_flag_reports.put(record.message_id, record)
+        self.db.add_flag(record, scores)
+        self.outbox.edit(mod_channel, flag.mod_message_id,
+                         '**Edited** ' + flag_post(message.author.name, message.id, message.content, scores))
+
+    async def handle_worker_scores(self, job, mod_message_id, scores):
+        # A worker process scored a message that it flagged (and already posted to the mod channel) or that
+        # counts towards its author's rolling risk
+        record = FlagRecord(job.message_id, job.channel_id, job.guild_id, job.author_id, job.author_name, job.content)
+        if mod_message_id is not None:
+            for attr in flagged_attributes(scores, self.tox_threshold, self.flirt_threshold):
+                FLAGS_RAISED.inc(attribute=attr)
+            record.mod_message_id = mod_message_id
+            self.track_flag(record, mod_message_id, scores)
+        escalation = self.risk.observe(job.channel_id, job.author_id, job.message_id, scores)
+        if escalation is None or mod_message_id is not None:
+            return
+        mod_channel = self.mod_channels.get(job.guild_id)
+        if mod_channel is not None:
+            self.escalate(record, job.content, escalation, mod_channel)
 
     async def on_raw_reaction_add(self, payload):
         '''
-        Handles the moderator's action to an automatically flagged message based on an emoji
+        Handles the moderator's action to an automatically flagged or user-reported message based on an emoji
         '''
-        if payload.guild_id and payload.channel_id == self.mod_channels[payload.guild_id].id and payload.event_type == 'REACTION_ADD':
-            message = self.mod_channel_messages.pop(payload.message_id)
-            main_channel_message_id = message.content.split(':')[
-                3].split('#')[1]
-            try:
-                main_channel_message = self.automatic_flag_reports.pop(
-                    int(main_channel_message_id))
-            except:
-                print("This message has already been handled!")
+        if not payload.guild_id or payload.event_type != 'REACTION_ADD':
+            return
+        mod_post = self.mod_channel_messages.get(payload.message_id)
+        if mod_post is None:
+            # Only reactions in the channels we post to are worth a trip to the database
+            if payload.channel_id not in self.mod_channel_ids and payload.channel_id != self.reports_channel_id:
                 return
-            if payload.emoji.name == resources.DEL_MSG_EMOJI:
-                # Simulate delete
-                await self.mod_channels[payload.guild_id].send(f'**Deleted** the following message:\n\n**From:** `{main_channel_message.author.name}`  **Message ID:**__`#{message.id}#`__   **Message Content:** : "`{main_channel_message.content}`" \n**At** `{datetime.now()}`')
-            elif payload.emoji.name == resources.BAN_USER_EMOJI:
-                # Simulate shadow ban
-                await self.mod_channels[payload.guild_id].send(f'**Shadow Banning** the user:\n`{main_channel_message.author.name}` for sending **Message ID:**__`#{message.id}#`__   **Message Content:** : "`{main_channel_message.content}`" \n**At** `{datetime.now()}`')
-            elif payload.emoji.name == resources.REPORT_AND_BAN_EMOJI:
-                # Simulate baning a user and sending the report to authorities
-                await self.mod_channels[payload.guild_id].send(f'`{main_channel_message.author.name}` is **Banded** for sending : **Message ID:**__`#{message.id}#`__   **Message Content:** : "`{main_channel_message.content}`" \n**At** `{datetime.now()}` this report has been shared with local authorities.')
-            elif payload.emoji.name == resources.RESOLVED_NO_ACTION:
-                # Simulate Resolved with no action.
-                await self.mod_channels[payload.guild_id].send(f'\nThis report has been marked as **Resolved** with no further actions.')
-            else:
-                # False positive case
-                await self.mod_channels[payload.guild_id].send(f'This was a false positive:\n`{main_channel_message.author.name}`  {payload.emoji.name}  Sent **Message ID:**__`#{message.id}#`__   **Message Content:** : "`{main_channel_message.content}`" \n**At** `{datetime.now()}`')
+            mod_post = await self.mod_channel_messages.fetch(payload.message_id)
+            if mod_post is None:
+                if payload.message_id in self.mod_channel_messages.handled:
+                    print("This message has already been handled!")
+                return
+        self.mod_channel_messages.pop(payload.message_id)
+        flag = await self.automatic_flag_reports.fetch(mod_post.flag_message_id, payload.guild_id)
+        if flag is None:
+            print("This message has already been handled!")
+            return
+        self.automatic_flag_reports.pop(mod_post.flag_message_id)
+        channel = self.get_channel(payload.channel_id)
+        if payload.emoji.name == resources.DEL_MSG_EMOJI:
+            action = 'deleted'
+            # Simulate delete
+            notice = f'**Deleted** the following message:\n\n**From:** `{flag.author_name}`  **Message ID:**__`#{payload.message_id}#`__   **Message Content:** : "`{flag.content}`" \n**At** `{datetime.now()}`'
+        elif payload.emoji.name == resources.BAN_USER_EMOJI:
+            action = 'banned'
+            # Simulate shadow ban
+            notice = f'**Shadow Banning** the user:\n`{flag.author_name}` for sending **Message ID:**__`#{payload.message_id}#`__   **Message Content:** : "`{flag.content}`" \n**At** `{datetime.now()}`'
+        elif payload.emoji.name == resources.REPORT_AND_BAN_EMOJI:
+            action = 'escalated'
+            # Simulate baning a user and sending the report to authorities
+            notice = f'`{flag.author_name}` is **Banded** for sending : **Message ID:**__`#{payload.message_id}#`__   **Message Content:** : "`{flag.content}`" \n**At** `{datetime.now()}` this report has been shared with local authorities.'
+        elif payload.emoji.name == resources.RESOLVED_NO_ACTION:
+            action = 'resolved'
+            # Simulate Resolved with no action.
+            notice = f'\nThis report has been marked as **Resolved** with no further actions.'
+        else:
+            action = 'false_positive'
+            # False positive case
+            notice = f'This was a false positive:\n`{flag.author_name}`  {payload.emoji.name}  Sent **Message ID:**__`#{payload.message_id}#`__   **Message Content:** : "`{flag.content}`" \n**At** `{datetime.now()}`'
+        self.outbox.post(channel, notice, NOTICE, coalesce=True)
+        self.db.add_decision(flag.message_id, payload.message_id, payload.guild_id,
+                             payload.user_id, payload.emoji.name, action)
+        DECISION_SECONDS.observe(time.time() - mod_post.created_at, action=action)
 
     async def on_raw_message_edit(self, payload):
         '''
         Handle edited messages in the main channel
         '''
-        if 'guild_id' in payload.data and payload.data['channel_id'] != self.mod_channels[int(payload.data['guild_id'])].id:
-            guild = self.get_guild(int(payload.data['guild_id']))
-            channel = guild.get_channel(int(payload.channel_id))
+        data = payload.data
+        # Updates without content (embeds unfurling, pins, ...) don't change what we would score
+        if 'guild_id' not in data or 'content' not in data:
+            return
+        if payload.cached_message is not None and payload.cached_message.content == data['content']:
+            return
+        if int(payload.channel_id) not in self.main_channel_ids:
+            return
+        channel = self.get_channel(int(payload.channel_id))
+        message = EditedMessage.from_payload(data, channel)
+        if message is None:
             message = await channel.fetch_message(int(payload.message_id))
-            await self.handle_channel_message(message)
+        self.edits.submit(message)
+
+    def report_session_counts(self):
+        counts = {(('state', state.name),): 0 for state in State}
+        for report in self.reports.values():
+            counts[(('state', report.state.name),)] += 1
+        return counts
 
-    def eval_text(self, message):
+    def warm_stores(self):
+        flags, mod_posts = self.db.load_pending(
+            max_age=self.automatic_flag_reports.max_age, limit=self.automatic_flag_reports.max_entries)
+        for record in flags:
+            self.automatic_flag_reports.put(record.message_id, record)
+        for record in mod_posts:
+            self.mod_channel_messages.put(record.message_id, record)
+
+    def track_flag(self, record, mod_message_id, scores=None):
+        '''
+        Remembers which flagged message a mod-channel post is about, so a reaction on the post
+        resolves with a single lookup instead of parsing the post's text.
+        '''
+        mod_post = ModPostRecord(mod_message_id, record.message_id)
+        self.automatic_flag_reports.put(record.message_id, record)
+        self.mod_channel_messages.put(mod_message_id, mod_post)
+        self.db.add_flag(record, scores)
+        self.db.add_mod_post(mod_post, record.guild_id)
+
+    def track_report(self, record, mod_message_id):
+        '''
+        Like track_flag, for our post about a user report. The report itself is already in the reports
+        table; if the message was flagged before, its flag (scores, status, mod post) is left alone.
+        '''
+        mod_post = ModPostRecord(mod_message_id, record.message_id)
+        if record.message_id not in self.automatic_flag_reports:
+            self.automatic_flag_reports.put(record.message_id, record)
+        self.mod_channel_messages.put(mod_message_id, mod_post)
+        self.db.add_flag(record, replace=False)
+        self.db.add_mod_post(mod_post, record.guild_id)
+
+    async def rehydrate_mod_post(self, message_id):
+        # Fallback for mod posts that were evicted from the store
+        return await self.db.get_mod_post(message_id)
+
+    async def rehydrate_flag(self, message_id, guild_id):
+        # Fallback for flagged messages that were evicted from the store
+        record = await self.db.get_flag(message_id)
+        if record is not None or await self.db.is_resolved(message_id):
+            return record
+        channel = self.main_channels.get(guild_id)
+        if channel is None:
+            return None
+        try:
+            message = await channel.fetch_message(message_id)
+        except discord.errors.NotFound:
+            return None
+        return FlagRecord.from_message(message)
+
+    async def eval_text(self, message):
         '''
         Given a message, forwards the message to Perspective and returns a dictionary of scores.
         '''
-        PERSPECTIVE_URL = 'https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze'
-
-        url = PERSPECTIVE_URL + '?key=' + self.perspective_key
-        data_dict = {
-            'comment': {'text': message.content},
-            # 'languages': ['en'],
-            'requestedAttributes': {
-                'SEVERE_TOXICITY': {}, 'PROFANITY': {},
-                'IDENTITY_ATTACK': {}, 'THREAT': {},
-                'TOXICITY': {}, 'FLIRTATION': {}
-            },
-            'doNotStore': True
-        }
-        response = requests.post(url, data=json.dumps(data_dict))
-        response_dict = response.json()
-
-        scores = {}
-        for attr in response_dict["attributeScores"]:
-            scores[attr] = response_dict["attributeScores"][attr]["summaryScore"]["value"]
+        # The message may have waited in the queue while the same content was scored
+        scores = self.score_cache.get(message.content, count=False)
+        if scores is not None:
+            SCORE_SOURCES.inc(source='cache')
+            return scores
 
+        # Identical content that is already being scored shares the one request
+        key = content_key(message.content)
+        if key in self.pending_scores:
+            SCORE_SOURCES.inc(source='coalesced')
+            return await asyncio.shield(self.pending_scores[key])
+        SCORE_SOURCES.inc(source='perspective')
+        future = asyncio.ensure_future(self.perspective.analyze(message.content))
+        self.pending_scores[key] = future
+        try:
+            scores = await asyncio.shield(future)
+        finally:
+            self.pending_scores.pop(key, None)
+        self.score_cache.put(message.content, scores)
         return scores
 
-    def code_format(self, text):
-        return "```" + text + "```"
+    async def close(self):
+        try:
+            await self.metrics.stop()
+            await self.reports.stop()
+            if self.worker_pool is not None:
+                await self.worker_pool.stop()
+            await self.edits.stop()
+            await self.scheduler.stop()
+            await self.outbox.stop()
+            await self.perspective.close()
+            try:
+                self.score_cache.save()
+            except OSError as e:
+                logger.error(f'Could not save the score cache to {self.score_cache.path}: {e}')
+        finally:
+            # Whatever failed above, the queued database writes must still be committed
+            self.db.close()
+            await super().close()
+
+
+class ShardedModBot(ModBot, discord.AutoShardedClient):
+    '''
+    ModBot running several gateway shards from one process.
+    '''
+
+
+def run_bot(args, shard_ids=None, process_index=0, perspective_qps=None):
+    log_listener = setup_logging(f'discord-{process_index}.log' if process_index else 'discord.log')
+    discord_token, perspective_key = load_tokens()
+    options = {}
+    if args.shard_count:
+        options['shard_count'] = args.shard_count
+        if shard_ids is not None and len(shard_ids) == 1:
+            options['shard_id'] = shard_ids[0]
+        else:
+            options['shard_ids'] = shard_ids
+    bot_class = ShardedModBot if args.shard_count and 'shard_id' not in options else ModBot
+    if perspective_qps is None:
+        perspective_qps = args.perspective_qps
+    # The processes share the moderation database (SQLite handles the locking, and a process can then act on
+    # reactions to posts another one made), but each saves its own score cache
+    score_cache_path = f'score_cache-{process_index}.json' if process_index else 'score_cache.json'
+    client = bot_class(perspective_key, score_cache_path=score_cache_path,
+                       metrics_port=args.metrics_port + process_index,
+                       classification_workers=args.workers, reports_channel_id=args.reports_channel_id,
+                       perspective_qps=perspective_qps, **options)
+    try:
+        # log_handler=None keeps discord.py from adding its own stderr handler (and resetting the level),
+        # which would write every record from the event loop and bypass the queue
+        client.run(discord_token, log_handler=None)
+    finally:
+        log_listener.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CS152 moderation bot')
+    parser.add_argument('--shard-count', type=int, default=None,
+                        help='total number of gateway shards across all processes')
+    parser.add_argument('--shard-ids', type=int, nargs='+', default=None,
+                        help='shards to run in this process (default: all of them)')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='split the shards over this many gateway processes')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='classification worker processes per gateway process (0 = score on the event loop)')
+    parser.add_argument('--reports-channel-id', type=int, default=None,
+                        help='channel to post user reports to (default: the mod channel of the reported guild)')
+    parser.add_argument('--perspective-qps', type=float, default=1.0,
+                        help='Perspective quota for the whole deployment; it is split evenly across the gateway '
+                             'processes and then across their classification workers')
+    parser.add_argument('--metrics-port', type=int, default=9108,
+                        help='metrics port of the first gateway process; the others count up from it')
+    args = parser.parse_args()
+
+    if args.processes <= 1:
+        run_bot(args, args.shard_ids)
+        return
+
+    # Deal the shards out round-robin, one gateway process each
+    shard_count = args.shard_count or args.processes
+    args.shard_count = shard_count
+    shard_ids = args.shard_ids or list(range(shard_count))
+    # All the processes share one API key, so each gets its slice of the quota
+    perspective_qps = args.perspective_qps / args.processes
+    processes = []
+    for i in range(args.processes):
+        process = multiprocessing.Process(target=run_bot,
+                                          args=(args, shard_ids[i::args.processes], i, perspective_qps))
+        process.start()
+        processes.append(process)
+    for process in processes:
+        process.join()
 
 
-client = ModBot(perspective_key)
-client.run(discord_token)
+if __name__ == '__main__':
+    main()
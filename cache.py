@@ -0,0 +1,104 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger('discord')
+
+ZERO_WIDTH = re.compile('[\u200b\u200c\u200d\u2060\ufeff\u00ad]')
+WHITESPACE = re.compile(r'\s+')
+
+
+def normalize(text):
+    '''
+    Folds case, zero-width characters and whitespace so that trivially different copies of a message share a key.
+    '''
+    text = ZERO_WIDTH.sub('', text)
+    text = WHITESPACE.sub(' ', text)
+    return text.strip().casefold()
+
+
+def content_key(text):
+    return hashlib.blake2b(normalize(text).encode('utf-8'), digest_size=16).hexdigest()
+
+
+class ScoreCache:
+    '''
+    LRU cache of Perspective scores keyed on the normalized message content. Entries expire after
+    `ttl` seconds and at most `max_entries` are kept. If `path` is given the cache can be saved to
+    and loaded from a JSON file so a restart doesn't start cold.
+    '''
+
+    def __init__(self, max_entries=10000, ttl=24 * 60 * 60, path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.entries = OrderedDict()  # key -> (time stored, scores)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, text, count=True):
+        '''
+        Returns the cached scores for `text`, or None. Pass count=False for repeat lookups of
+        the same message so the hit/miss counters stay meaningful.
+        '''
+        key = content_key(text)
+        entry = self.entries.get(key)
+        if entry is not None and time.time() - entry[0] > self.ttl:
+            del self.entries[key]
+            entry = None
+        if entry is None:
+            if count:
+                self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        if count:
+            self.hits += 1
+        return entry[1]
+
+    def put(self, text, scores):
+        key = content_key(text)
+        self.entries[key] = (time.time(), scores)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def load(self):
+        if not self.path or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f'Could not load score cache from {self.path}: {e}')
+            return
+        now = time.time()
+        # Saved oldest first, so replaying keeps the LRU order
+        for key, stored, scores in saved:
+            if now - stored <= self.ttl:
+                self.entries[key] = (stored, scores)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump([[key, stored, scores] for key, (stored, scores) in self.entries.items()], f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,217 @@
+import asyncio
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from store import FlagRecord, ModPostRecord
+
+logger = logging.getLogger('discord')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS flags (
+    message_id INTEGER PRIMARY KEY,
+    guild_id INTEGER,
+    channel_id INTEGER,
+    author_id INTEGER,
+    author_name TEXT,
+    content TEXT,
+    scores TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    created_at REAL,
+    resolved_at REAL,
+    mod_message_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS flags_author ON flags (author_id);
+CREATE INDEX IF NOT EXISTS flags_guild ON flags (guild_id, status);
+
+CREATE TABLE IF NOT EXISTS reports (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    message_id INTEGER,
+    guild_id INTEGER,
+    channel_id INTEGER,
+    author_id INTEGER,
+    author_name TEXT,
+    content TEXT,
+    reporter_id INTEGER,
+    report_type TEXT,
+    child_solicitation INTEGER NOT NULL DEFAULT 0,
+    created_at REAL
+);
+CREATE INDEX IF NOT EXISTS reports_message ON reports (message_id);
+CREATE INDEX IF NOT EXISTS reports_author ON reports (author_id);
+CREATE INDEX IF NOT EXISTS reports_guild ON reports (guild_id);
+
+CREATE TABLE IF NOT EXISTS mod_posts (
+    mod_message_id INTEGER PRIMARY KEY,
+    message_id INTEGER,
+    guild_id INTEGER,
+    created_at REAL
+);
+CREATE INDEX IF NOT EXISTS mod_posts_message ON mod_posts (message_id);
+
+CREATE TABLE IF NOT EXISTS decisions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    message_id INTEGER,
+    mod_message_id INTEGER,
+    guild_id INTEGER,
+    moderator_id INTEGER,
+    emoji TEXT,
+    action TEXT,
+    decided_at REAL
+);
+CREATE INDEX IF NOT EXISTS decisions_message ON decisions (message_id);
+CREATE INDEX IF NOT EXISTS decisions_mod_message ON decisions (mod_message_id);
+CREATE INDEX IF NOT EXISTS decisions_guild ON decisions (guild_id, decided_at);
+'''
+
+
+class ModerationDB:
+    '''
+    SQLite (WAL mode) record of flags, user reports, mod-channel posts and moderator decisions.
+    Writes are queued and committed in batches by a background thread, so callers on the event
+    loop never wait on disk. Reads go through the default executor.
+    '''
+
+    def __init__(self, path='moderation.db', batch_size=100, flush_interval=0.5):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._reader = self._connect()
+        self._reader.executescript(SCHEMA)
+        self._migrate()
+        self._read_lock = threading.Lock()
+        self._writes = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name='moderation-db', daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _migrate(self):
+        # Databases created before flags remembered their mod post
+        columns = {row[1] for row in self._reader.execute('PRAGMA table_info(flags)')}
+        if 'mod_message_id' not in columns:
+            self._reader.execute('ALTER TABLE flags ADD COLUMN mod_message_id INTEGER')
+            self._reader.commit()
+
+    def _write_loop(self):
+        conn = self._connect()
+        closing = False
+        while not closing:
+            batch = [self._writes.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._writes.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            if None in batch:
+                closing = True
+                batch = [op for op in batch if op is not None]
+            try:
+                with conn:
+                    for sql, params in batch:
+                        conn.execute(sql, params)
+            except sqlite3.Error:
+                logger.exception(f'Writing {len(batch)} moderation records failed')
+        conn.close()
+
+    def _write(self, sql, params):
+        self._writes.put((sql, params))
+
+    def close(self):
+        self._writes.put(None)
+        self._writer.join()
+        self._reader.close()
+
+    async def _read(self, sql, params=()):
+        def run():
+            with self._read_lock:
+                return self._reader.execute(sql, params).fetchall()
+        return await asyncio.get_event_loop().run_in_executor(None, run)
+
+    # Writes
+
+    def add_flag(self, record, scores=None, replace=True):
+        # With replace=False an existing row for the message (and its scores and status) is kept
+        conflict = 'REPLACE' if replace else 'IGNORE'
+        self._write(f'INSERT OR {conflict} INTO flags (message_id, guild_id, channel_id, author_id, author_name, '
+                    'content, scores, status, created_at, mod_message_id) VALUES (?, ?, ?, ?, ?, ?, ?, \'pending\', ?, ?)',
+                    (record.message_id, record.guild_id, record.channel_id, record.author_id,
+                     record.author_name, record.content, json.dumps(scores), record.created_at, record.mod_message_id))
+
+    def add_report(self, record, reporter_id, report_type, child_solicitation=False):
+        self._write('INSERT INTO reports (message_id, guild_id, channel_id, author_id, author_name, content, '
+                    'reporter_id, report_type, child_solicitation, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (record.message_id, record.guild_id, record.channel_id, record.author_id, record.author_name,
+                     record.content, reporter_id, report_type, int(child_solicitation), record.created_at))
+
+    def add_mod_post(self, record, guild_id):
+        self._write('INSERT OR REPLACE INTO mod_posts (mod_message_id, message_id, guild_id, created_at) '
+                    'VALUES (?, ?, ?, ?)', (record.message_id, record.flag_message_id, guild_id, record.created_at))
+
+    def add_decision(self, message_id, mod_message_id, guild_id, moderator_id, emoji, action):
+        now = time.time()
+        self._write('UPDATE flags SET status = ?, resolved_at = ? WHERE message_id = ?',
+                    (action, now, message_id))
+        self._write('INSERT INTO decisions (message_id, mod_message_id, guild_id, moderator_id, emoji, action, '
+                    'decided_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (message_id, mod_message_id, guild_id, moderator_id, emoji, action, now))
+
+    # Reads
+
+    async def get_flag(self, message_id, pending_only=True):
+        rows = await self._read(
+            'SELECT message_id, channel_id, guild_id, author_id, author_name, content, created_at, mod_message_id '
+            'FROM flags WHERE message_id = ?' + (' AND status = \'pending\'' if pending_only else ''),
+            (message_id,))
+        return FlagRecord(*rows[0]) if rows else None
+
+    async def is_resolved(self, message_id):
+        rows = await self._read(
+            'SELECT 1 FROM flags WHERE message_id = ? AND status != \'pending\'', (message_id,))
+        return bool(rows)
+
+    async def get_mod_post(self, mod_message_id):
+        rows = await self._read(
+            'SELECT mod_message_id, message_id, created_at FROM mod_posts WHERE mod_message_id = ?',
+            (mod_message_id,))
+        return ModPostRecord(*rows[0]) if rows else None
+
+    async def history(self, guild_id=None, author_id=None, limit=50):
+        '''
+        Most recent moderator decisions, optionally narrowed down to a guild and/or the flagged author.
+        '''
+        sql = ('SELECT d.decided_at, d.action, d.emoji, d.moderator_id, f.author_id, f.author_name, f.content '
+               'FROM decisions d LEFT JOIN flags f ON f.message_id = d.message_id WHERE 1 = 1')
+        params = []
+        if guild_id is not None:
+            sql += ' AND d.guild_id = ?'
+            params.append(guild_id)
+        if author_id is not None:
+            sql += ' AND f.author_id = ?'
+            params.append(author_id)
+        sql += ' ORDER BY d.decided_at DESC LIMIT ?'
+        params.append(limit)
+        return await self._read(sql, params)
+
+    def load_pending(self, max_age=None, limit=10000):
+        '''
+        Pending flags and the mod posts that point at them, newest last, for warming the in-memory stores on startup.
+        '''
+        since = time.time() - max_age if max_age is not None else 0
+        with self._read_lock:
+            flag_rows = self._reader.execute(
+                'SELECT message_id, channel_id, guild_id, author_id, author_name, content, created_at, mod_message_id FROM ('
+                'SELECT * FROM flags WHERE status = \'pending\' AND created_at >= ? '
+                'ORDER BY created_at DESC LIMIT ?) ORDER BY created_at', (since, limit)).fetchall()
+            post_rows = self._reader.execute(
+                'SELECT p.mod_message_id, p.message_id, p.created_at FROM mod_posts p '
+                'JOIN flags f ON f.message_id = p.message_id WHERE f.status = \'pending\' AND p.created_at >= ? '
+                'ORDER BY p.created_at', (since,)).fetchall()
+        return [FlagRecord(*row) for row in flag_rows], [ModPostRecord(*row) for row in post_rows]
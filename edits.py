@@ -0,0 +1,124 @@
+'''
+Re-scoring of edited channel messages. Edits are read straight from the gateway payload, edits that
+leave the (normalized) text unchanged are skipped and bursts of edits to one message are scored once.
+'''
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from cache import content_key
+
+logger = logging.getLogger('discord')
+
+
+class EditedAuthor:
+    __slots__ = ('id', 'name')
+
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+
+class EditedMessage:
+    '''
+    The parts of an edited message that the classification path reads, built from a MESSAGE_UPDATE
+    payload so that no REST call is needed to fetch the message.
+    '''
+    __slots__ = ('id', 'content', 'author', 'channel', 'guild')
+
+    def __init__(self, id, content, author, channel):
+        self.id = id
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+
+    @classmethod
+    def from_payload(cls, data, channel):
+        '''
+        Returns None if the payload doesn't carry the content and author, e.g. for embed-only updates.
+        '''
+        if 'content' not in data or 'author' not in data:
+            return None
+        author = EditedAuthor(int(data['author']['id']), data['author']['username'])
+        return cls(int(data['id']), data['content'], author, channel)
+
+
+class EditDebouncer:
+    '''
+    Hands edited messages to `evaluate(message)` once they have gone `delay` seconds without another
+    edit, and only if the text differs from what was last scored for that message. The last scored
+    content key of up to `max_entries` messages is remembered.
+    '''
+
+    def __init__(self, evaluate, delay=2.0, max_entries=10000):
+        self.evaluate = evaluate
+        self.delay = delay
+        self.max_entries = max_entries
+        self.scored = OrderedDict()  # Message id -> content key of the text last scored
+        self.pending = {}  # Message id -> [deadline, latest edited message]
+        self.tasks = set()
+        self.submitted = 0
+        self.unchanged = 0
+        self.debounced = 0
+        self.evaluated = 0
+
+    def remember(self, message_id, content):
+        self.scored[message_id] = content_key(content)
+        self.scored.move_to_end(message_id)
+        while len(self.scored) > self.max_entries:
+            self.scored.popitem(last=False)
+
+    def submit(self, message):
+        self.submitted += 1
+        if self.scored.get(message.id) == content_key(message.content):
+            self.unchanged += 1
+            return
+        deadline = time.monotonic() + self.delay
+        entry = self.pending.get(message.id)
+        if entry is not None:
+            # Push the evaluation back and score the newest text instead
+            entry[0] = deadline
+            entry[1] = message
+            self.debounced += 1
+            return
+        self.pending[message.id] = [deadline, message]
+        task = asyncio.ensure_future(self._wait(message.id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _wait(self, message_id):
+        while True:
+            remaining = self.pending[message_id][0] - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(remaining)
+        _, message = self.pending.pop(message_id)
+        if self.scored.get(message.id) == content_key(message.content):
+            # Edited back to the text we already scored
+            self.unchanged += 1
+            return
+        self.remember(message.id, message.content)
+        self.evaluated += 1
+        try:
+            await self.evaluate(message)
+        except Exception:
+            logger.exception(f'Re-scoring edited message {message_id} failed')
+
+    async def join(self):
+        while self.tasks:
+            await asyncio.gather(*self.tasks)
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.pending = {}
+
+    def stats(self):
+        return {
+            'submitted': self.submitted,
+            'unchanged': self.unchanged,
+            'debounced': self.debounced,
+            'evaluated': self.evaluated,
+        }
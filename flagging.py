@@ -0,0 +1,49 @@
+'''
+Deciding whether a set of scores gets a message flagged, and what the flag looks like in the mod channel.
+Shared by the bot and the classification worker processes.
+'''
+import json
+import resources
+
+REACTION_INSTRUCTIONS = ('Please use one of the following reactions:'
+                         + '\n\n'+resources.DEL_MSG_EMOJI+' `Delete` the reported message'
+                         + '\n\n'+resources.BAN_USER_EMOJI+' `Ban` the reported user'
+                         + '\n\n'+resources.REPORT_AND_BAN_EMOJI +
+                         ' `Ban` the reported user and `Escalate` this incident to local authorities'
+                         + '\n\n'+resources.RESOLVED_NO_ACTION +
+                         ' Mark this report as `Resolved` with no further actions'
+                         + '\n\n'+'Select any other reaction to mark the report as false alarm')
+
+
+def flagged_attributes(scores, tox_threshold, flirt_threshold):
+    '''
+    Returns the attributes whose score is over their threshold; the message should be flagged if there are any.
+    '''
+    return [attr for attr, value in scores.items()
+            if value > (flirt_threshold if attr == 'FLIRTATION' else tox_threshold)]
+
+
+def code_format(text):
+    return "```" + text + "```"
+
+
+def flag_post(author_name, message_id, content, scores):
+    return (f'**Suspected message:**\n**Suspected abuser:** {author_name} \n**Message ID:**__`#{message_id}#`__ **Message Content:** `{content}`'+'\n' +
+            '**Message Suspicion Score:**\n'+code_format(json.dumps(scores, indent=2))+'\n'+REACTION_INSTRUCTIONS)
+
+
+def pattern_post(author_name, message_id, content, message_ids, risk):
+    # One post for a run of borderline messages; reactions act on the latest of them
+    return (f'**Suspected pattern of messages:**\n**Suspected abuser:** {author_name} \n**Latest message ID:**__`#{message_id}#`__ **Message Content:** `{content}`'+'\n' +
+            '**Recent message IDs:** ' + ', '.join(f'`{id}`' for id in message_ids) + '\n' +
+            '**Rolling Suspicion Score:**\n'+code_format(json.dumps(risk, indent=2))+'\n'+REACTION_INSTRUCTIONS)
+
+
+def report_post(author_name, message_id, content, report_type, child_solicitation=False):
+    # A user report; POTENTIAL_CHILD_SOLICITATION ones get a banner so they stand out in the channel
+    banner = ''
+    if child_solicitation:
+        banner = (f'🚨🚨🚨🚨🚨🚨🚨🚨🚨\n'+'🚨🚨   **High Priority**   🚨🚨\n'+'🚨🚨🚨🚨🚨🚨🚨🚨🚨\n\n\n'
+                  + '**POTENTIAL_CHILD_SOLICITATION**\n\n')
+    return (banner + f'**Suspected message:**\n**Suspected abuser:** {author_name} \n**Message ID:**__`#{message_id}#`__ **Message Content:** `{content}`'+'\n' +
+            f'**Message report type:**`{report_type}`' + '\n'+REACTION_INSTRUCTIONS)
@@ -0,0 +1,217 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+import discord
+from scheduler import TokenBucket
+
+logger = logging.getLogger('discord')
+
+# Send order within a channel; lower goes first
+URGENT = 0   # POTENTIAL_CHILD_SOLICITATION escalations
+REPORT = 1   # reports submitted by users
+FLAG = 2     # automatic flags
+NOTICE = 3   # confirmations of moderator decisions
+
+# Discord's limit on the length of a message
+MESSAGE_LIMIT = 2000
+
+
+class Outgoing:
+    __slots__ = ('priority', 'content', 'on_sent', 'edit_id', 'queued_at')
+
+    def __init__(self, priority, content, on_sent=None, edit_id=None):
+        self.priority = priority
+        self.content = content
+        self.on_sent = on_sent
+        self.edit_id = edit_id  # Id of one of our earlier posts to replace instead of sending a new one
+        self.queued_at = time.monotonic()
+
+
+class PostQueue(asyncio.PriorityQueue):
+    '''
+    Priority queue of (priority, order, post) entries that can give up its least urgent entry to make room.
+    '''
+
+    def evict_lowest(self, priority):
+        '''
+        Removes and returns the least urgent queued post if it is less urgent than `priority`, else None.
+        '''
+        if not self._queue:
+            return None
+        entry = max(self._queue)
+        if entry[0] <= priority:
+            return None
+        self._queue.remove(entry)
+        heapq.heapify(self._queue)
+        self.task_done()
+        return entry[2]
+
+
+class ChannelOutbox:
+    '''
+    Pending posts for one channel, sent highest priority first by a background task. Sends are paced by
+    a token bucket matched to Discord's per-channel rate limit, so we pick what goes out next instead of
+    queueing up behind discord.py's rate-limit lock. Once `max_queue` posts are waiting, a new post
+    replaces the least urgent queued FLAG or NOTICE if that is less urgent than it; URGENT and REPORT
+    posts are never dropped or refused and go over the limit if there is nothing to replace.
+    '''
+
+    def __init__(self, channel, rate, burst, max_queue, digest_interval):
+        self.channel = channel
+        self.bucket = TokenBucket(rate, burst)
+        self.max_queue = max_queue
+        self.queue = PostQueue()
+        self.digest_interval = digest_interval
+        self.digest = []
+        self.sent = 0
+        self.failed = 0
+        self.evicted = 0
+        self._order = itertools.count()
+        self._tasks = [asyncio.ensure_future(self._sender())]
+        if digest_interval:
+            self._tasks.append(asyncio.ensure_future(self._digest_loop()))
+
+    def put(self, item):
+        '''
+        Returns False if the post was refused because the queue is full of posts at least as urgent.
+        '''
+        if self.queue.qsize() >= self.max_queue:
+            # Only routine posts make room; a report is never dropped, not even for an urgent one
+            evicted = self.queue.evict_lowest(max(item.priority, REPORT))
+            if evicted is not None:
+                self.evicted += 1
+                logger.warning(f'Outbox for channel {self.channel.id} is full, dropped a queued post of priority '
+                               f'{evicted.priority} to make room')
+            elif item.priority > REPORT:
+                return False
+        # The counter keeps posts of the same priority in the order they were queued
+        self.queue.put_nowait((item.priority, next(self._order), item))
+        return True
+
+    async def _sender(self):
+        while True:
+            _, _, item = await self.queue.get()
+            try:
+                await self.bucket.acquire()
+                if item.edit_id is not None:
+                    message = await self.channel.get_partial_message(item.edit_id).edit(content=item.content)
+                else:
+                    message = await self.channel.send(item.content)
+                self.sent += 1
+                if item.on_sent is not None:
+                    item.on_sent(message)
+            except discord.HTTPException as e:
+                self.failed += 1
+                logger.error(f'Posting to channel {self.channel.id} failed: {e}')
+            except Exception:
+                self.failed += 1
+                logger.exception(f'Handling a post to channel {self.channel.id} failed')
+            finally:
+                self.queue.task_done()
+
+    async def _digest_loop(self):
+        while True:
+            await asyncio.sleep(self.digest_interval)
+            self.flush_digest()
+
+    def flush_digest(self):
+        '''
+        Queues the notices collected since the last flush as few messages as fit in Discord's limit.
+        '''
+        chunk = []
+        length = 0
+        for content in self.digest:
+            if chunk and length + len(content) + 2 > MESSAGE_LIMIT:
+                self.put(Outgoing(NOTICE, '\n\n'.join(chunk)))
+                chunk = []
+                length = 0
+            chunk.append(content)
+            length += len(content) + 2
+        if chunk:
+            self.put(Outgoing(NOTICE, '\n\n'.join(chunk)))
+        self.digest = []
+
+    async def stop(self, timeout):
+        if self.digest:
+            self.flush_digest()
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f'Gave up on {self.queue.qsize()} unsent posts to channel {self.channel.id}')
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+class Outbox:
+    '''
+    Everything the bot posts to mod channels goes through here, so handlers return as soon as the post
+    is queued. Each channel gets its own ChannelOutbox, sending at most `rate` posts per second with
+    bursts of up to `burst`. If `digest_interval` is set, posts queued with `coalesce=True` are collected
+    and sent together every `digest_interval` seconds instead of one by one.
+    '''
+
+    def __init__(self, rate=1.0, burst=5, max_queue=5000, digest_interval=None):
+        self.rate = rate
+        self.burst = burst
+        self.max_queue = max_queue
+        self.digest_interval = digest_interval
+        self.channels = {}  # Map from channel id to its ChannelOutbox
+        self.dropped = 0
+
+    def post(self, channel, content, priority=FLAG, on_sent=None, coalesce=False):
+        '''
+        Queues `content` for `channel`. `on_sent(message)` is called with the posted message, except for
+        coalesced posts, which are sent as part of a digest. Returns False if the channel's queue is full
+        of posts at least as urgent, which never happens for URGENT and REPORT posts.
+        '''
+        outbox = self._outbox(channel)
+        if coalesce and self.digest_interval:
+            outbox.digest.append(content)
+            return True
+        return self._put(outbox, Outgoing(priority, content, on_sent))
+
+    def edit(self, channel, message_id, content, priority=FLAG, on_sent=None):
+        '''
+        Queues replacing the content of our post `message_id` in `channel`, e.g. when the flagged message was edited.
+        '''
+        return self._put(self._outbox(channel), Outgoing(priority, content, on_sent, edit_id=message_id))
+
+    def _outbox(self, channel):
+        outbox = self.channels.get(channel.id)
+        if outbox is None:
+            outbox = self.channels[channel.id] = ChannelOutbox(
+                channel, self.rate, self.burst, self.max_queue, self.digest_interval)
+        return outbox
+
+    def _put(self, outbox, item):
+        if not outbox.put(item):
+            self.dropped += 1
+            logger.warning(f'Outbox for channel {outbox.channel.id} is full, dropped a post')
+            return False
+        return True
+
+    def __len__(self):
+        return sum(outbox.queue.qsize() + len(outbox.digest) for outbox in self.channels.values())
+
+    async def join(self):
+        for outbox in list(self.channels.values()):
+            await outbox.queue.join()
+
+    async def stop(self, timeout=5.0):
+        '''
+        Gives queued posts up to `timeout` seconds per channel to go out, then stops the senders.
+        '''
+        await asyncio.gather(*(outbox.stop(timeout) for outbox in self.channels.values()))
+        self.channels = {}
+
+    def stats(self):
+        return {
+            'queued': len(self),
+            'sent': sum(outbox.sent for outbox in self.channels.values()),
+            'failed': sum(outbox.failed for outbox in self.channels.values()),
+            'dropped': self.dropped,
+            'evicted': sum(outbox.evicted for outbox in self.channels.values()),
+        }
@@ -0,0 +1,131 @@
+import asyncio
+import json
+import logging
+import random
+import time
+import aiohttp
+from telemetry import PERSPECTIVE_RESPONSES, PERSPECTIVE_SECONDS
+
+logger = logging.getLogger('discord')
+
+PERSPECTIVE_URL = 'https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze'
+
+REQUESTED_ATTRIBUTES = ['SEVERE_TOXICITY', 'PROFANITY',
+                        'IDENTITY_ATTACK', 'THREAT', 'TOXICITY', 'FLIRTATION']
+
+# Status codes that are worth another try after backing off
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class PerspectiveError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class PerspectiveClient:
+    '''
+    Async client for the Perspective API. Connections are kept alive in a pooled aiohttp session,
+    at most `max_concurrency` requests are in flight at once, and failed requests are retried
+    with exponential backoff. If a `rate_limiter` (scheduler.TokenBucket) is given, every request
+    spends a token from it and a 429 pauses it.
+    '''
+
+    def __init__(self, key, url=PERSPECTIVE_URL, max_concurrency=8, timeout=10.0,
+                 max_retries=3, backoff_base=0.5, backoff_max=8.0, rate_limiter=None, rate_limit_pause=1.0):
+        self.key = key
+        self.url = url
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_limiter = rate_limiter
+        self.rate_limit_pause = rate_limit_pause
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._session = None
+
+    def _get_session(self):
+        # The session has to be created from inside the running event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_concurrency, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={'Content-Type': 'application/json'})
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def _backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        delay = min(self.backoff_base * (2 ** attempt), self.backoff_max)
+        # Full jitter so that a burst of retries doesn't come back in lockstep
+        return random.uniform(0, delay)
+
+    async def analyze(self, text):
+        '''
+        Sends `text` to Perspective and returns a dictionary of attribute -> summary score.
+        Raises PerspectiveError once the retries are used up.
+        '''
+        data_dict = {
+            'comment': {'text': text},
+            # 'languages': ['en'],
+            'requestedAttributes': {attr: {} for attr in REQUESTED_ATTRIBUTES},
+            'doNotStore': True
+        }
+        body = json.dumps(data_dict)
+        params = {'key': self.key}
+
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire()
+            try:
+                async with self._semaphore:
+                    session = self._get_session()
+                    start = time.perf_counter()
+                    async with session.post(self.url, params=params, data=body) as response:
+                        PERSPECTIVE_SECONDS.observe(time.perf_counter() - start)
+                        PERSPECTIVE_RESPONSES.inc(status=response.status)
+                        if response.status == 200:
+                            response_dict = await response.json(content_type=None)
+                            return self.parse_scores(response_dict)
+                        text_body = await response.text()
+                        last_error = PerspectiveError(
+                            f'Perspective returned {response.status}: {text_body[:200]}', response.status)
+                        if response.status not in RETRY_STATUSES:
+                            raise last_error
+                        if 'Retry-After' in response.headers:
+                            try:
+                                retry_after = float(response.headers['Retry-After'])
+                            except ValueError:
+                                pass
+                        if response.status == 429 and self.rate_limiter is not None:
+                            # Everyone else should back off too, not just this request
+                            self.rate_limiter.pause(retry_after or self.rate_limit_pause)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                PERSPECTIVE_RESPONSES.inc(status='error')
+                last_error = PerspectiveError(f'Perspective request failed: {e!r}')
+
+            if attempt < self.max_retries:
+                delay = self._backoff(attempt, retry_after)
+                logger.warning('%s, retrying in %.2fs', last_error, delay)
+                await asyncio.sleep(delay)
+
+        raise last_error
+
+    @staticmethod
+    def parse_scores(response_dict):
+        if 'attributeScores' not in response_dict:
+            raise PerspectiveError(
+                f'Malformed Perspective response: {json.dumps(response_dict)[:200]}')
+        scores = {}
+        for attr in response_dict['attributeScores']:
+            scores[attr] = response_dict['attributeScores'][attr]['summaryScore']['value']
+        return scores
@@ -0,0 +1,129 @@
+import re
+import time
+from collections import deque
+import resources
+from cache import normalize
+from perspective import REQUESTED_ATTRIBUTES
+
+WORD = re.compile(r"[\w']+")
+
+
+class TermMatcher:
+    '''
+    Aho-Corasick automaton over a fixed set of terms, so a message is scanned once no matter
+    how many terms there are. Only whole-word matches are reported.
+    '''
+
+    def __init__(self, terms):
+        # terms maps each term to the label reported when it matches
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for term, label in terms.items():
+            self._add(normalize(term), label)
+        self._build()
+
+    def _add(self, term, label):
+        node = 0
+        for ch in term:
+            if ch not in self.goto[node]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[node][ch] = len(self.goto) - 1
+            node = self.goto[node][ch]
+        self.output[node].append((len(term), label))
+
+    def _build(self):
+        # Breadth-first, so every node's failure link is ready before its children need it
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self.goto[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and ch not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                if node:
+                    self.fail[child] = self.goto[fallback].get(ch, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def find(self, text):
+        '''
+        Returns the set of labels whose terms occur as whole words in the (already normalized) text.
+        '''
+        labels = set()
+        node = 0
+        for end, ch in enumerate(text):
+            while node and ch not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(ch, 0)
+            for length, label in self.output[node]:
+                start = end - length + 1
+                if (start == 0 or not text[start - 1].isalnum()) and \
+                        (end + 1 == len(text) or not text[end + 1].isalnum()):
+                    labels.add(label)
+        return labels
+
+
+class PreFilter:
+    '''
+    Cheap local first stage in front of Perspective. Obvious hits and obviously benign messages get
+    synthetic scores straight away, so they go through the usual threshold checks without an API call;
+    everything else returns None and is forwarded to Perspective.
+    '''
+
+    def __init__(self, flag_terms=None, benign_terms=None, hit_score=1.0, max_benign_words=6):
+        if flag_terms is None:
+            flag_terms = resources.PREFILTER_FLAG_TERMS
+        if benign_terms is None:
+            benign_terms = resources.PREFILTER_BENIGN_TERMS
+        self.matcher = TermMatcher(
+            {term: attr for attr, terms in flag_terms.items() for term in terms})
+        self.benign_words = frozenset(normalize(term) for term in benign_terms)
+        self.hit_score = hit_score
+        self.max_benign_words = max_benign_words
+
+        self.checked = 0
+        self.cleared = 0
+        self.flagged = 0
+        self.forwarded = 0
+        self.total_ns = 0
+
+    def classify(self, text):
+        start = time.perf_counter_ns()
+        scores = self._classify(text)
+        self.total_ns += time.perf_counter_ns() - start
+        self.checked += 1
+        if scores is None:
+            self.forwarded += 1
+        elif max(scores.values()) > 0:
+            self.flagged += 1
+        else:
+            self.cleared += 1
+        return scores
+
+    def _classify(self, text):
+        text = normalize(text)
+        hits = self.matcher.find(text)
+        if hits:
+            return {attr: self.hit_score if attr in hits else 0.0 for attr in REQUESTED_ATTRIBUTES}
+
+        # Nothing but punctuation/emoji (no letters or digits in any script)
+        if not any(ch.isalnum() for ch in text):
+            return {attr: 0.0 for attr in REQUESTED_ATTRIBUTES}
+        # A short message made up of small talk
+        words = WORD.findall(text)
+        if len(words) <= self.max_benign_words and all(w in self.benign_words for w in words):
+            return {attr: 0.0 for attr in REQUESTED_ATTRIBUTES}
+        return None
+
+    def stats(self):
+        return {
+            'checked': self.checked,
+            'cleared': self.cleared,
+            'flagged': self.flagged,
+            'forwarded': self.forwarded,
+            'api_calls_avoided': self.cleared + self.flagged,
+            'avg_us': self.total_ns / self.checked / 1000 if self.checked else 0.0,
+        }
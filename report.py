@@ -1,10 +1,16 @@
 from enum import Enum, auto
 from typing import Text
+import asyncio
 import discord
+import logging
 import re
 import resources
+import time
+from collections import OrderedDict
 from datetime import datetime
 
+logger = logging.getLogger('discord')
+
 
 class State(Enum):
     REPORT_START = auto()
@@ -15,86 +21,112 @@ class State(Enum):
     REPORT_SUBMITID = auto()
 
 
+ABUSE_TYPES = {resources.INTIMATE_KEYWORD, resources.SELF_KEYWORD, resources.HATE_KEYWORD,
+               resources.VIOLENCE_KEYWORD, resources.SPAM_KEYWORD, resources.OTHER_KEYWORD}
+
+
 class Report:
     START_KEYWORD = "report"
     CANCEL_KEYWORD = "cancel"
     HELP_KEYWORD = "help"
-    reported_message = None
-    reported_user = None
-    type = None
+    # Everything a report knows lives on the instance, so concurrent reporters don't see each other's data
+    __slots__ = ('state', 'client', 'message', 'reported_message', 'type', 'last_active')
 
     def __init__(self, client):
         self.state = State.REPORT_START
         self.client = client
         self.message = None
+        self.reported_message = None
+        self.type = None
+        self.last_active = time.monotonic()
 
     async def handle_message(self, message):
         '''
-        This function makes up the meat of the user-side reporting flow. It defines how we transition between states and what 
-        prompts to offer at each of those states. You're welcome to change anything you want; this skeleton is just here to
-        get you started and give you a model for working with Discord. 
+        This function makes up the meat of the user-side reporting flow. The state we are in picks the
+        handler (see HANDLERS below), which returns the prompts to send back and moves us to the next state.
         '''
-
+        self.last_active = time.monotonic()
         if message.content == self.CANCEL_KEYWORD:
             self.state = State.REPORT_COMPLETE
             return ["Report cancelled."]
 
-        if self.state == State.REPORT_START:
-            reply = "Thank you for starting the reporting process. "
-            reply += "Say `help` at any time for more information.\n\n"
-            reply += "Please copy paste the link to the message you want to report.\n"
-            reply += "You can obtain this link by right-clicking the message and clicking `Copy Message Link`."
-            self.state = State.AWAITING_MESSAGE
-            return [reply]
-
-        if self.state == State.AWAITING_MESSAGE:
-            # Parse out the three ID strings from the message link
-            m = re.search('/(\d+)/(\d+)/(\d+)', message.content)
-            if not m:
-                return ["I'm sorry, I couldn't read that link. Please try again or say `cancel` to cancel."]
-            guild = self.client.get_guild(int(m.group(1)))
-            if not guild:
-                return ["I cannot accept reports of messages from guilds that I'm not in. Please have the guild owner add me to the guild and try again."]
+        handler = self.HANDLERS.get(self.state)
+        if handler is None:
+            return []
+        return await handler(self, message)
+
+    async def start(self, message):
+        reply = "Thank you for starting the reporting process. "
+        reply += "Say `help` at any time for more information.\n\n"
+        reply += "Please copy paste the link to the message you want to report.\n"
+        reply += "You can obtain this link by right-clicking the message and clicking `Copy Message Link`."
+        self.state = State.AWAITING_MESSAGE
+        return [reply]
+
+    async def find_message(self, message):
+        # Parse out the three ID strings from the message link
+        m = re.search('/(\d+)/(\d+)/(\d+)', message.content)
+        if not m:
+            return ["I'm sorry, I couldn't read that link. Please try again or say `cancel` to cancel."]
+        guild = self.client.get_guild(int(m.group(1)))
+        if guild:
             channel = guild.get_channel(int(m.group(2)))
-            if not channel:
-                return ["It seems this channel was deleted or never existed. Please try again or say `cancel` to cancel."]
+        else:
+            # DMs only arrive on shard 0, so with several gateway processes the guild may just belong to
+            # another one; the REST API tells us whether we are in it
             try:
-                message = await channel.fetch_message(int(m.group(3)))
+                channel = await self.client.fetch_channel(int(m.group(2)))
+            except discord.errors.Forbidden:
+                channel = None
             except discord.errors.NotFound:
-                return ["It seems this message was deleted or never existed. Please try again or say `cancel` to cancel."]
-
-            # Here we've found the message - it's up to you to decide what to do next!
-            self.state = State.MESSAGE_IDENTIFIED
-            Report.reported_message = message
-            return ["I found this message: ", "```" + message.author.name + ": " + message.content + "```",
-                    "If this is not the right message, type `cancel` and restart to reporting process.\n" +
-                    "Otherwise, let me know which of the following abuse types this message is\n" +
-                    '`' + resources.INTIMATE_KEYWORD + '`\n`' + resources.SELF_KEYWORD + '`\n`' +
-                    resources.HATE_KEYWORD + '`\n`' + resources.VIOLENCE_KEYWORD + '`\n`' +
-                    resources.SPAM_KEYWORD + '`\n`' + resources.OTHER_KEYWORD + '`']
-
-        if self.state == State.MESSAGE_IDENTIFIED:
-            if message.content == resources.INTIMATE_KEYWORD or message.content == resources.SELF_KEYWORD or message.content == resources.HATE_KEYWORD or message.content == resources.HATE_KEYWORD or message.content == resources.SELF_KEYWORD or message.content == resources.OTHER_KEYWORD:
-                Report.type = message.content
-                return [f"\nWe are sorry to hear that you received a concerning message. In order to properly prioritize your message, will you let us know if you are under the age of 18?\nPlease respond `{resources.UNDERAGE_KEYWORD}` or `{resources.OVERAGE_KEYWORD}` "]
-            if message.content == resources.UNDERAGE_KEYWORD:
-                self.state = State.POTENTIAL_CHILD_SOLICITATION
-                return [f" Thanks so much for letting us know. **You are so brave!** For your safety, we've prevented this user from contacting you again.{self.send_solicitation_resources()}\n**Reported user:** `{message.author.name}` **Reported message:** `{message.content}` \n**At:**`{datetime.now()}` "]
-            elif message.content == resources.OVERAGE_KEYWORD:
-                return [f"Thanks for letting us know! We will contact you when we have reviewed your case. In the meantime, would you like to block the user from this conversation? Reply `{resources.BLOCK_KEYWORD}` or `{resources.DO_NOT_BLOCK_KEYWORD}`:"]
-            elif message.content == resources.BLOCK_KEYWORD:
-                self.state = State.REPORT_SUBMITID
-                return [f"We have **Blocked** {message.author.name} and prevented the account from any future interactions.\nYour report is **Successfully submitted**\n**Reported user:** `{message.author.name}` **Reported message:** `{message.content}` \n**At:**`{datetime.now()}`"]
-            elif message.content == resources.DO_NOT_BLOCK_KEYWORD:
-                self.state = State.REPORT_SUBMITID
-                return [f"Your report is **Successfully submitted**\n**Reported user:** `{message.author.name}` **Reported message:** `{message.content}` \n**At:**`{datetime.now()}`"]
-            else:
-                return [f"I'm sorry, I didn't get that. In order to properly prioritize your message, will you let us know if you are under 18? Please respond `{resources.UNDERAGE_KEYWORD}` or `{resources.OVERAGE_KEYWORD}`: "]
-
-        if self.state == State.POTENTIAL_CHILD_SOLICITATION:
-            return self.send_solicitation_resources()
-
-        return []
+                return ["It seems this channel was deleted or never existed. Please try again or say `cancel` to cancel."]
+            if channel is None or getattr(channel, 'guild', None) is None or channel.guild.id != int(m.group(1)):
+                return ["I cannot accept reports of messages from guilds that I'm not in. Please have the guild owner add me to the guild and try again."]
+        if not channel:
+            return ["It seems this channel was deleted or never existed. Please try again or say `cancel` to cancel."]
+        try:
+            message = await channel.fetch_message(int(m.group(3)))
+        except discord.errors.NotFound:
+            return ["It seems this message was deleted or never existed. Please try again or say `cancel` to cancel."]
+
+        # Here we've found the message - it's up to you to decide what to do next!
+        self.state = State.MESSAGE_IDENTIFIED
+        self.reported_message = message
+        return ["I found this message: ", "```" + message.author.name + ": " + message.content + "```",
+                "If this is not the right message, type `cancel` and restart to reporting process.\n" +
+                "Otherwise, let me know which of the following abuse types this message is\n" +
+                '`' + resources.INTIMATE_KEYWORD + '`\n`' + resources.SELF_KEYWORD + '`\n`' +
+                resources.HATE_KEYWORD + '`\n`' + resources.VIOLENCE_KEYWORD + '`\n`' +
+                resources.SPAM_KEYWORD + '`\n`' + resources.OTHER_KEYWORD + '`']
+
+    async def classify(self, message):
+        if message.content in ABUSE_TYPES:
+            self.type = message.content
+            return [f"\nWe are sorry to hear that you received a concerning message. In order to properly prioritize your message, will you let us know if you are under the age of 18?\nPlease respond `{resources.UNDERAGE_KEYWORD}` or `{resources.OVERAGE_KEYWORD}` "]
+        if message.content == resources.UNDERAGE_KEYWORD:
+            self.state = State.POTENTIAL_CHILD_SOLICITATION
+            return [f" Thanks so much for letting us know. **You are so brave!** For your safety, we've prevented this user from contacting you again.{self.send_solicitation_resources()}\n**Reported user:** `{message.author.name}` **Reported message:** `{message.content}` \n**At:**`{datetime.now()}` "]
+        elif message.content == resources.OVERAGE_KEYWORD:
+            return [f"Thanks for letting us know! We will contact you when we have reviewed your case. In the meantime, would you like to block the user from this conversation? Reply `{resources.BLOCK_KEYWORD}` or `{resources.DO_NOT_BLOCK_KEYWORD}`:"]
+        elif message.content == resources.BLOCK_KEYWORD:
+            self.state = State.REPORT_SUBMITID
+            return [f"We have **Blocked** {message.author.name} and prevented the account from any future interactions.\nYour report is **Successfully submitted**\n**Reported user:** `{message.author.name}` **Reported message:** `{message.content}` \n**At:**`{datetime.now()}`"]
+        elif message.content == resources.DO_NOT_BLOCK_KEYWORD:
+            self.state = State.REPORT_SUBMITID
+            return [f"Your report is **Successfully submitted**\n**Reported user:** `{message.author.name}` **Reported message:** `{message.content}` \n**At:**`{datetime.now()}`"]
+        else:
+            return [f"I'm sorry, I didn't get that. In order to properly prioritize your message, will you let us know if you are under 18? Please respond `{resources.UNDERAGE_KEYWORD}` or `{resources.OVERAGE_KEYWORD}`: "]
+
+    async def child_solicitation_resources(self, message):
+        return self.send_solicitation_resources()
+
+    # State -> handler for the next message in that state. States without one ignore further messages.
+    HANDLERS = {
+        State.REPORT_START: start,
+        State.AWAITING_MESSAGE: find_message,
+        State.MESSAGE_IDENTIFIED: classify,
+        State.POTENTIAL_CHILD_SOLICITATION: child_solicitation_resources,
+    }
 
     def send_solicitation_resources(self):
         text1 = """
@@ -115,3 +147,84 @@ class Report:
 
     def child_solicitation(self):
         return self.state == State.POTENTIAL_CHILD_SOLICITATION
+
+
+class ReportSessions:
+    '''
+    The report in progress for each user, capped at `max_sessions`. Sessions are kept in order of last
+    activity, so a sweeper running every `sweep_interval` seconds can drop the ones idle for longer than
+    `ttl` seconds by looking only at the front of the map.
+    '''
+
+    def __init__(self, client, max_sessions=5000, ttl=30 * 60, sweep_interval=60.0):
+        self.client = client
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.sessions = OrderedDict()  # Map from user IDs to their Report, least recently active first
+        self.expired = 0
+        self.refused = 0
+        self._sweeper = None
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, user_id):
+        return user_id in self.sessions
+
+    def values(self):
+        return self.sessions.values()
+
+    def get(self, user_id):
+        report = self.sessions.get(user_id)
+        if report is not None:
+            self.sessions.move_to_end(user_id)
+        return report
+
+    def start(self, user_id):
+        '''
+        Opens a new report for `user_id`. Returns None if we are already at the session cap.
+        '''
+        self.start_sweeper()
+        if len(self.sessions) >= self.max_sessions:
+            self.sweep()
+            if len(self.sessions) >= self.max_sessions:
+                self.refused += 1
+                return None
+        report = self.sessions[user_id] = Report(self.client)
+        return report
+
+    def pop(self, user_id):
+        return self.sessions.pop(user_id, None)
+
+    def sweep(self):
+        cutoff = time.monotonic() - self.ttl
+        while self.sessions:
+            user_id, report = next(iter(self.sessions.items()))
+            if report.last_active >= cutoff:
+                break
+            self.sessions.popitem(last=False)
+            self.expired += 1
+            logger.debug(f'Report session of user {user_id} expired in state {report.state.name}')
+
+    def start_sweeper(self):
+        if self._sweeper is None:
+            self._sweeper = asyncio.ensure_future(self._sweep_loop())
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            self.sweep()
+
+    async def stop(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+
+    def stats(self):
+        return {
+            'sessions': len(self.sessions),
+            'expired': self.expired,
+            'refused': self.refused,
+        }
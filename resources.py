@@ -24,3 +24,21 @@ SPAM_KEYWORD = "spam"
 SELF_KEYWORD = "self harm"
 OTHER_KEYWORD = "other"
 
+'''
+Pre-filter term lists
+'''
+# Messages hitting one of these are flagged without asking Perspective. Matching is case
+# insensitive and on whole words, so keep the terms unambiguous.
+PREFILTER_FLAG_TERMS = {
+    'THREAT': ['kill yourself', 'kys', 'i will kill you', 'i am going to kill you', 'you are dead'],
+    'PROFANITY': ['fuck you', 'motherfucker'],
+    'FLIRTATION': ['send nudes', 'send me nudes', 'send pics', 'our little secret',
+                   "don't tell your parents", 'dont tell your parents'],
+}
+
+# Messages made up only of these words (and punctuation/emoji) are cleared without asking Perspective
+PREFILTER_BENIGN_TERMS = [
+    'ok', 'okay', 'k', 'kk', 'lol', 'lmao', 'haha', 'hahaha', 'yes', 'yeah', 'yep', 'no', 'nope',
+    'hi', 'hello', 'hey', 'bye', 'thanks', 'thank', 'you', 'thx', 'ty', 'np', 'sure', 'cool',
+    'nice', 'good', 'great', 'morning', 'night', 'gn', 'gm', 'brb', 'omg', 'wow', 'same', 'agreed',
+]
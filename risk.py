@@ -0,0 +1,155 @@
+'''
+Streaming per-author, per-channel risk. A message can stay under the flagging thresholds while the
+author's recent messages taken together clearly shouldn't; this keeps a small rolling window per
+author and channel and says when their decayed total crosses the escalation line.
+'''
+import math
+import time
+from array import array
+from collections import OrderedDict
+from perspective import REQUESTED_ATTRIBUTES
+
+ATTRIBUTE_INDEX = {attr: i for i, attr in enumerate(REQUESTED_ATTRIBUTES)}
+
+
+class AuthorWindow:
+    '''
+    The last `size` scored messages of one author in one channel, in fixed-size ring buffers.
+    '''
+    __slots__ = ('message_ids', 'times', 'values', 'next', 'count', 'last_seen', 'escalated')
+
+    def __init__(self, size):
+        self.message_ids = array('q', bytes(8 * size))
+        self.times = array('d', bytes(8 * size))
+        self.values = array('f', bytes(4 * size * len(REQUESTED_ATTRIBUTES)))
+        self.next = 0
+        self.count = 0
+        self.last_seen = 0.0
+        self.escalated = False
+
+    def add(self, message_id, scores, now):
+        size = len(self.times)
+        # An edited message replaces its earlier scores rather than counting twice
+        for slot in range(self.count):
+            if self.message_ids[slot] == message_id:
+                break
+        else:
+            slot = self.next
+            self.next = (self.next + 1) % size
+            self.count = min(self.count + 1, size)
+        self.message_ids[slot] = message_id
+        self.times[slot] = now
+        base = slot * len(REQUESTED_ATTRIBUTES)
+        for i, attr in enumerate(REQUESTED_ATTRIBUTES):
+            self.values[base + i] = scores.get(attr, 0.0)
+        self.last_seen = now
+
+    def recent_message_ids(self, attributes, floor):
+        '''
+        Ids of the messages, newest first, that scored at or above `floor` on any of `attributes` (indices).
+        '''
+        size = len(self.times)
+        stride = len(REQUESTED_ATTRIBUTES)
+        ids = []
+        for i in range(self.count):
+            slot = (self.next - 1 - i) % size
+            if any(self.values[slot * stride + attr] >= floor for attr in attributes):
+                ids.append(self.message_ids[slot])
+        return ids
+
+
+class RiskAggregator:
+    '''
+    Keeps an AuthorWindow of `window` messages for each (channel, author). An attribute's risk is the sum
+    of that attribute's scores at or above `floor` over the window, each decayed by its age with a
+    half-life of `half_life` seconds. When an attribute reaches `escalate_at` with at least `min_messages`
+    messages contributing, `observe` returns the risk per attribute and the attributes that got there,
+    once, until that author's risk falls back below half the line. At most `max_authors` windows are kept; the least recently active
+    go first, and windows idle for `idle_ttl` seconds are dropped.
+    '''
+
+    def __init__(self, floor=0.3, escalate_at=1.5, min_messages=3, half_life=60 * 60, window=16,
+                 max_authors=10000, idle_ttl=6 * 60 * 60):
+        self.floor = floor
+        self.escalate_at = escalate_at
+        self.min_messages = min_messages
+        self.decay = math.log(2) / half_life
+        self.window = window
+        self.max_authors = max_authors
+        self.idle_ttl = idle_ttl
+        self.authors = OrderedDict()  # (channel id, author id) -> AuthorWindow, least recently active first
+        self.escalations = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.authors)
+
+    def observe(self, channel_id, author_id, message_id, scores, now=None):
+        now = time.time() if now is None else now
+        key = (channel_id, author_id)
+        author = self.authors.get(key)
+        if author is None:
+            # Most authors never score anywhere near the floor; they don't need a window
+            if all(value < self.floor for value in scores.values()):
+                return None
+            author = self.authors[key] = AuthorWindow(self.window)
+        else:
+            self.authors.move_to_end(key)
+        author.add(message_id, scores, now)
+        self.evict(now)
+
+        risk = self.risk(author, now)
+        if author.escalated:
+            if max(value for value, _ in risk.values()) < self.escalate_at / 2:
+                author.escalated = False
+            return None
+        triggered = [attr for attr, (value, count) in risk.items()
+                     if value >= self.escalate_at and count >= self.min_messages]
+        if triggered:
+            author.escalated = True
+            self.escalations += 1
+            return {attr: round(value, 3) for attr, (value, _) in risk.items()}, triggered
+        return None
+
+    def risk(self, author, now):
+        '''
+        Decayed risk and the number of contributing messages, per attribute.
+        '''
+        attributes = len(REQUESTED_ATTRIBUTES)
+        totals = [0.0] * attributes
+        counts = [0] * attributes
+        for slot in range(author.count):
+            weight = math.exp(-self.decay * (now - author.times[slot]))
+            base = slot * attributes
+            for i in range(attributes):
+                value = author.values[base + i]
+                if value >= self.floor:
+                    totals[i] += weight * value
+                    counts[i] += 1
+        return {attr: (totals[i], counts[i]) for attr, i in ATTRIBUTE_INDEX.items()}
+
+    def recent_message_ids(self, channel_id, author_id, attributes):
+        '''
+        The author's messages in the window that count towards the risk of any of `attributes`, newest first.
+        '''
+        author = self.authors.get((channel_id, author_id))
+        if author is None:
+            return []
+        return author.recent_message_ids([ATTRIBUTE_INDEX[attr] for attr in attributes], self.floor)
+
+    def evict(self, now):
+        cutoff = now - self.idle_ttl
+        while self.authors:
+            oldest = next(iter(self.authors.values()))
+            if len(self.authors) > self.max_authors or oldest.last_seen < cutoff:
+                self.authors.popitem(last=False)
+                self.evicted += 1
+            else:
+                break
+
+    def stats(self):
+        return {
+            'authors': len(self.authors),
+            'escalations': self.escalations,
+            'evicted': self.evicted,
+        }
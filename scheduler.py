@@ -0,0 +1,220 @@
+import asyncio
+import functools
+import logging
+import time
+from cache import content_key
+from telemetry import CLASSIFICATION_DROPPED
+
+logger = logging.getLogger('discord')
+
+# What to do with a new message when the intake queue is full
+DEFER = 'defer'              # wait for room; discord.py runs each event in its own task, so the waiting
+                             # on_message calls pile up without limit instead of slowing the gateway down
+DROP_NEWEST = 'drop_newest'  # refuse the new message
+DROP_OLDEST = 'drop_oldest'  # make room by discarding the longest waiting message
+OVERFLOW_POLICIES = (DEFER, DROP_NEWEST, DROP_OLDEST)
+
+
+class TokenBucket:
+    '''
+    Classic token bucket: `rate` tokens are added per second, up to `capacity`.
+    '''
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    async def acquire(self):
+        # The lock keeps waiters in FIFO order instead of racing for each token
+        async with self._lock:
+            while True:
+                now = self._refill()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        '''
+        Stop handing out tokens for `seconds`, e.g. after the remote side told us to slow down.
+        '''
+        self._refill()
+        self.tokens = 0
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class ClassificationScheduler:
+    '''
+    Sits between on_message and eval_text. Messages go into a bounded intake queue and a dispatcher
+    pulls them off in micro-batches (up to `batch_size` messages or `batch_window` seconds, whichever
+    comes first). Messages in a batch with the same normalized content are scored with a single call, so
+    a burst of copies costs one call; up to `max_in_flight` distinct texts are scored concurrently and a
+    slow one only holds its own slot. Each result is handed to `on_scored(message, scores)`. Messages
+    that waited more than `max_wait` seconds are dropped unscored.
+    Pacing against the API quota is left to the TokenBucket the Perspective client spends from, so
+    messages answered from the cache don't use up tokens.
+    '''
+
+    def __init__(self, score, on_scored, max_queue=500, batch_size=8, batch_window=0.05,
+                 max_in_flight=32, overflow_policy=DROP_OLDEST, max_wait=60.0, stats_interval=60.0, on_error=None):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy {overflow_policy!r}')
+        self.score = score
+        self.on_scored = on_scored
+        self.on_error = on_error
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.max_in_flight = max_in_flight
+        self.overflow_policy = overflow_policy
+        self.max_wait = max_wait
+        self.stats_interval = stats_interval
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._workers = []
+        self._in_flight = set()
+
+        # Counters for tuning
+        self.submitted = 0
+        self.processed = 0
+        self.dropped = 0
+        self.expired = 0
+        self.errors = 0
+        self.total_wait = 0.0
+        self.max_seen_wait = 0.0
+        self.max_seen_depth = 0
+
+    def start(self):
+        if self._workers:
+            return
+        self._workers.append(asyncio.ensure_future(self._worker()))
+        if self.stats_interval:
+            self._workers.append(asyncio.ensure_future(self._log_stats()))
+
+    async def stop(self):
+        tasks = self._workers + list(self._in_flight)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+
+    async def submit(self, message):
+        '''
+        Queues a message for scoring. Returns False if the message was dropped because the queue is full.
+        '''
+        self.start()
+        item = (time.monotonic(), message)
+        if self.queue.full():
+            if self.overflow_policy == DROP_NEWEST:
+                self.dropped += 1
+                CLASSIFICATION_DROPPED.inc(reason='overflow')
+                return False
+            if self.overflow_policy == DROP_OLDEST:
+                try:
+                    _, oldest = self.queue.get_nowait()
+                    self.queue.task_done()
+                    self.dropped += 1
+                    CLASSIFICATION_DROPPED.inc(reason='overflow')
+                    logger.warning(f'Classification queue is full, dropped message {oldest.id} unscored')
+                except asyncio.QueueEmpty:
+                    pass
+        # With DEFER this waits for room and so slows the caller down to our pace
+        await self.queue.put(item)
+        self.submitted += 1
+        self.max_seen_depth = max(self.max_seen_depth, self.queue.qsize())
+        return True
+
+    async def _next_batch(self):
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _worker(self):
+        while True:
+            batch = await self._next_batch()
+            groups = {}  # Content key -> [(enqueued, message)], in arrival order
+            now = time.monotonic()
+            for enqueued, message in batch:
+                waited = now - enqueued
+                if self.max_wait is not None and waited > self.max_wait:
+                    # Too stale to be worth a paid call
+                    self.expired += 1
+                    CLASSIFICATION_DROPPED.inc(reason='expired')
+                    logger.warning(f'Message {message.id} waited {waited:.1f}s to be scored, dropped it unscored')
+                    self.queue.task_done()
+                    continue
+                groups.setdefault(content_key(message.content), []).append((enqueued, message))
+            for group in groups.values():
+                await self._slots.acquire()
+                now = time.monotonic()
+                for enqueued, _ in group:
+                    self.total_wait += now - enqueued
+                    self.max_seen_wait = max(self.max_seen_wait, now - enqueued)
+                task = asyncio.ensure_future(self._process([message for _, message in group]))
+                self._in_flight.add(task)
+                task.add_done_callback(functools.partial(self._finished, len(group)))
+
+    def _finished(self, count, task):
+        self._in_flight.discard(task)
+        self._slots.release()
+        for _ in range(count):
+            self.queue.task_done()
+
+    async def _process(self, messages):
+        # All the messages have the same content, so the first one's scores do for the rest
+        try:
+            scores = await self.score(messages[0])
+        except Exception as e:
+            self.errors += len(messages)
+            for message in messages:
+                if self.on_error is not None:
+                    self.on_error(message, e)
+                else:
+                    logger.error(f'Could not score message {message.id}: {e}')
+            return
+        self.processed += len(messages)
+        for message in messages:
+            try:
+                await self.on_scored(message, scores)
+            except Exception:
+                logger.exception(f'Handling scores for message {message.id} failed')
+
+    async def _log_stats(self):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            logger.info('Classification scheduler: %s', self.stats())
+
+    def stats(self):
+        scored = max(self.processed + self.errors, 1)
+        return {
+            'queue_depth': self.queue.qsize(),
+            'in_flight': len(self._in_flight),
+            'max_queue_depth': self.max_seen_depth,
+            'submitted': self.submitted,
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'expired': self.expired,
+            'errors': self.errors,
+            'avg_wait': self.total_wait / scored,
+            'max_wait': self.max_seen_wait,
+        }
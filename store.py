@@ -0,0 +1,130 @@
+import sys
+import time
+from collections import OrderedDict
+
+# How much of a flagged message's content we keep around for the mod channel
+SNIPPET_LENGTH = 300
+
+
+class FlagRecord:
+    '''
+    What the reaction handler needs to know about a flagged message, without holding on to the discord.Message.
+    `mod_message_id` is set for automatic flags once they are posted, so an edit can update the post in place.
+    '''
+    __slots__ = ('message_id', 'channel_id', 'guild_id', 'author_id', 'author_name', 'content', 'created_at',
+                 'mod_message_id')
+
+    def __init__(self, message_id, channel_id, guild_id, author_id, author_name, content, created_at=None,
+                 mod_message_id=None):
+        self.message_id = message_id
+        self.channel_id = channel_id
+        self.guild_id = guild_id
+        self.author_id = author_id
+        self.author_name = author_name
+        self.content = content[:SNIPPET_LENGTH]
+        self.created_at = created_at if created_at is not None else time.time()
+        self.mod_message_id = mod_message_id
+
+    @classmethod
+    def from_message(cls, message):
+        return cls(message.id, message.channel.id, message.guild.id if message.guild else None,
+                   message.author.id, message.author.name, message.content)
+
+    def size(self):
+        return sys.getsizeof(self) + sys.getsizeof(self.author_name) + sys.getsizeof(self.content)
+
+
+class ModPostRecord:
+    '''
+    One of our own posts in the mod channel and the flagged message it is about.
+    '''
+    __slots__ = ('message_id', 'flag_message_id', 'created_at')
+
+    def __init__(self, message_id, flag_message_id, created_at=None):
+        self.message_id = message_id
+        self.flag_message_id = flag_message_id
+        self.created_at = created_at if created_at is not None else time.time()
+
+    def size(self):
+        return sys.getsizeof(self)
+
+
+class BoundedStore:
+    '''
+    Insertion-ordered map of id -> record that never holds more than `max_entries` records or
+    roughly `max_bytes` bytes, and drops records older than `max_age` seconds. Evicted records can
+    be rebuilt on demand through `fetch`, which calls the async `loader(key, *args)` on a miss.
+    Keys that were popped (i.e. handled) are remembered so they aren't rehydrated a second time.
+    '''
+
+    def __init__(self, max_entries=10000, max_bytes=None, max_age=7 * 24 * 60 * 60, loader=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.loader = loader
+        self.records = OrderedDict()
+        self.bytes = 0
+        self.handled = OrderedDict()
+        self.evicted = 0
+        self.rehydrated = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def put(self, key, record):
+        if key in self.records:
+            self.bytes -= self.records.pop(key).size()
+        self.records[key] = record
+        self.bytes += record.size()
+        self.handled.pop(key, None)
+        self.evict()
+
+    def get(self, key):
+        return self.records.get(key)
+
+    def pop(self, key):
+        record = self.records.pop(key, None)
+        if record is not None:
+            self.bytes -= record.size()
+        self.handled[key] = None
+        while len(self.handled) > self.max_entries:
+            self.handled.popitem(last=False)
+        return record
+
+    async def fetch(self, key, *args):
+        '''
+        Returns the record for `key`, asking the loader to rebuild it if it was evicted.
+        Returns None for unknown keys and for keys that have already been handled.
+        '''
+        record = self.records.get(key)
+        if record is not None or key in self.handled or self.loader is None:
+            return record
+        record = await self.loader(key, *args)
+        if record is not None:
+            self.rehydrated += 1
+            self.put(key, record)
+        return record
+
+    def evict(self):
+        cutoff = time.time() - self.max_age if self.max_age is not None else None
+        while self.records:
+            key, oldest = next(iter(self.records.items()))
+            if len(self.records) > self.max_entries or \
+                    (self.max_bytes is not None and self.bytes > self.max_bytes) or \
+                    (cutoff is not None and oldest.created_at < cutoff):
+                self.records.popitem(last=False)
+                self.bytes -= oldest.size()
+                self.evicted += 1
+            else:
+                break
+
+    def stats(self):
+        return {
+            'entries': len(self.records),
+            'bytes': self.bytes,
+            'evicted': self.evicted,
+            'rehydrated': self.rehydrated,
+        }
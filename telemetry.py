@@ -0,0 +1,245 @@
+import asyncio
+import bisect
+import logging
+import logging.handlers
+import os
+import queue
+import time
+from aiohttp import web
+
+logger = logging.getLogger('discord')
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DECISION_BUCKETS = (5, 15, 30, 60, 120, 300, 600, 1800, 3600, 4 * 3600, 24 * 3600)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key):
+    if not key:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in key) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, value
+
+
+class Gauge:
+    '''
+    A value read at scrape time from `collect()`, which returns either a number or a dict mapping
+    label tuples such as (('state', 'REPORT_START'),) to numbers.
+    '''
+    kind = 'gauge'
+
+    def __init__(self, name, help, collect):
+        self.name = name
+        self.help = help
+        self.collect = collect
+
+    def samples(self):
+        value = self.collect()
+        if isinstance(value, dict):
+            for labels, v in value.items():
+                yield self.name, labels, v
+        else:
+            yield self.name, (), value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.series = {}  # label key -> [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [0] * (len(self.buckets) + 2)
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        for key, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                yield self.name + '_bucket', key + (('le', bound),), cumulative
+            yield self.name + '_bucket', key + (('le', '+Inf'),), series[-1]
+            yield self.name + '_sum', key, series[-2]
+            yield self.name + '_count', key, series[-1]
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric):
+        if metric.name in self.metrics:
+            return self.metrics[metric.name]
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help):
+        return self._register(Counter(name, help))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, buckets))
+
+    def gauge(self, name, help, collect):
+        # Gauges are re-registered by each ModBot, so the newest collector wins
+        self.metrics[name] = Gauge(name, help, collect)
+        return self.metrics[name]
+
+    def render(self):
+        '''
+        Prometheus text exposition format.
+        '''
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            try:
+                for name, key, value in metric.samples():
+                    lines.append(f'{name}{_format_labels(key)} {value}')
+            except Exception:
+                logger.exception(f'Collecting {metric.name} failed')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+ON_MESSAGE_SECONDS = REGISTRY.histogram(
+    'modbot_on_message_seconds', 'Time spent in on_message, by kind of message')
+PERSPECTIVE_SECONDS = REGISTRY.histogram(
+    'modbot_perspective_request_seconds', 'Latency of individual Perspective requests')
+PERSPECTIVE_RESPONSES = REGISTRY.counter(
+    'modbot_perspective_responses_total', 'Perspective responses by HTTP status (or "error" for transport failures)')
+CLASSIFICATION_DROPPED = REGISTRY.counter(
+    'modbot_classification_dropped_total', 'Messages dropped without being scored, by reason')
+SCORE_SOURCES = REGISTRY.counter(
+    'modbot_scores_total', 'Messages scored, by where the scores came from')
+FLAGS_RAISED = REGISTRY.counter(
+    'modbot_flags_raised_total', 'Messages flagged to the mod channel, by attribute over its threshold')
+RISK_ESCALATIONS = REGISTRY.counter(
+    'modbot_risk_escalations_total', 'Consolidated flags raised for an author\'s recent messages, by attribute')
+DECISION_SECONDS = REGISTRY.histogram(
+    'modbot_decision_seconds', 'Time from posting a flag to a moderator reacting to it, by action', DECISION_BUCKETS)
+
+
+class MetricsExporter:
+    '''
+    Serves the registry at http://host:port/metrics and/or writes it to `dump_path` every `dump_interval` seconds.
+    '''
+
+    def __init__(self, registry=REGISTRY, host='127.0.0.1', port=None, dump_path=None, dump_interval=60.0):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.dump_path = dump_path
+        self.dump_interval = dump_interval
+        self._runner = None
+        self._dump_task = None
+
+    async def _metrics(self, request):
+        return web.Response(text=self.registry.render(), content_type='text/plain', charset='utf-8')
+
+    async def start(self):
+        if self.port is not None and self._runner is None:
+            app = web.Application()
+            app.router.add_get('/metrics', self._metrics)
+            self._runner = web.AppRunner(app)
+            await self._runner.setup()
+            await web.TCPSite(self._runner, self.host, self.port).start()
+        if self.dump_path is not None and self._dump_task is None:
+            self._dump_task = asyncio.ensure_future(self._dump_loop())
+
+    async def _dump_loop(self):
+        while True:
+            await asyncio.sleep(self.dump_interval)
+            self.dump()
+
+    def dump(self):
+        tmp_path = self.dump_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.registry.render())
+        os.replace(tmp_path, self.dump_path)
+
+    async def stop(self):
+        if self._dump_task is not None:
+            self._dump_task.cancel()
+            self._dump_task = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+class SamplingFilter(logging.Filter):
+    '''
+    Lets through one in `rate` DEBUG records from discord.py's own modules (gateway chatter mostly).
+    Our records on the 'discord' logger itself and anything at INFO or above always pass.
+    '''
+
+    def __init__(self, rate=100):
+        super().__init__()
+        self.rate = rate
+        self.seen = 0
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or record.name == 'discord':
+            return True
+        self.seen += 1
+        return self.seen % self.rate == 0
+
+
+def setup_queue_logging(target, level=logging.DEBUG, debug_sample_rate=100):
+    '''
+    Routes the 'discord' logger through a queue so that handlers doing file I/O run on a background
+    thread instead of the event loop. Returns the listener, which should be stopped on shutdown.
+    '''
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(debug_sample_rate))
+    logger.setLevel(level)
+    logger.addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(log_queue, target, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,46 @@
+import asyncio
+from outbox import FLAG, NOTICE, REPORT, URGENT, Outbox
+
+
+class Channel:
+    def __init__(self, id):
+        self.id = id
+        self.sent = []
+
+    async def send(self, content):
+        self.sent.append(content)
+        return content
+
+
+def test_urgent_posts_evict_routine_ones_when_full():
+    async def run():
+        outbox = Outbox(rate=1000, burst=1000, max_queue=3)
+        channel = Channel(1)
+        for i in range(3):
+            assert outbox.post(channel, f'flag {i}', FLAG)
+        # Nothing has been sent yet, so the queue is full
+        assert outbox.post(channel, 'urgent', URGENT)
+        assert not outbox.post(channel, 'notice', NOTICE)
+        await outbox.join()
+        await outbox.stop()
+        return channel.sent, outbox.dropped
+
+    sent, dropped = asyncio.run(run())
+    assert sent == ['urgent', 'flag 0', 'flag 1']
+    assert dropped == 1
+
+
+def test_reports_are_never_refused():
+    async def run():
+        outbox = Outbox(rate=1000, burst=1000, max_queue=2)
+        channel = Channel(1)
+        for i in range(4):
+            assert outbox.post(channel, f'report {i}', REPORT)
+        assert outbox.post(channel, 'urgent', URGENT)
+        await outbox.join()
+        await outbox.stop()
+        return channel.sent, outbox.dropped
+
+    sent, dropped = asyncio.run(run())
+    assert sent == ['urgent', 'report 0', 'report 1', 'report 2', 'report 3']
+    assert dropped == 0
@@ -0,0 +1,50 @@
+from cache import normalize
+from perspective import REQUESTED_ATTRIBUTES
+from prefilter import PreFilter, TermMatcher
+
+
+def test_term_matcher_finds_whole_words_only():
+    matcher = TermMatcher({'kys': 'THREAT', 'send pics': 'FLIRTATION'})
+    assert matcher.find(normalize('just KYS already')) == {'THREAT'}
+    assert matcher.find(normalize('pls send   pics')) == {'FLIRTATION'}
+    assert matcher.find(normalize('skys are blue')) == set()
+    assert matcher.find(normalize('kysa')) == set()
+
+
+def test_term_matcher_overlapping_terms():
+    matcher = TermMatcher({'he': 'A', 'she': 'B', 'hers': 'C'})
+    assert matcher.find('she') == {'B'}
+    assert matcher.find('hers') == {'C'}
+    assert matcher.find('ushers') == set()
+
+
+def test_term_matcher_non_ascii():
+    matcher = TermMatcher({'убью': 'THREAT', '白痴': 'TOXICITY'})
+    assert matcher.find(normalize('я тебя убью!')) == {'THREAT'}
+    assert matcher.find(normalize('убьют')) == set()
+
+
+def test_classify_flags_known_terms():
+    scores = PreFilter().classify('kill yourself')
+    assert scores['THREAT'] == 1.0
+    assert set(scores) == set(REQUESTED_ATTRIBUTES)
+
+
+def test_classify_clears_small_talk_and_punctuation():
+    prefilter = PreFilter()
+    assert max(prefilter.classify('ok thanks lol').values()) == 0.0
+    assert max(prefilter.classify('!!! 🎉🎉 ...').values()) == 0.0
+
+
+def test_classify_forwards_everything_else():
+    prefilter = PreFilter()
+    assert prefilter.classify('you are such an idiot') is None
+    assert prefilter.classify('ok ok ok ok ok ok ok') is None
+
+
+def test_classify_forwards_non_latin_scripts():
+    prefilter = PreFilter()
+    assert prefilter.classify('идиот, я тебя убью') is None
+    assert prefilter.classify('你是个白痴') is None
+    assert prefilter.classify('ok 你是个白痴') is None
+    assert prefilter.classify('ok 😀 привет') is None
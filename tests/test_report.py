@@ -0,0 +1,77 @@
+import asyncio
+import os
+from bench.fakes import FakeDMChannel, FakeMessage, FakeUser, ReplayBot, next_id
+from report import ReportSessions, State
+
+
+def run_with_bot(tmp_path, scenario):
+    async def run():
+        bot = ReplayBot('test-key', db_path=os.path.join(tmp_path, 'moderation.db'), score_cache_path=None)
+        await bot.on_ready()
+        try:
+            return await scenario(bot)
+        finally:
+            await bot.close()
+    return asyncio.run(run())
+
+
+def link(bot, message):
+    return f'https://discord.com/channels/{bot.guild.id}/{bot.main_channel.id}/{message.id}'
+
+
+async def say(bot, user, channel, content):
+    await bot.handle_dm(FakeMessage(next_id(), content, user, channel))
+
+
+def test_concurrent_reports_keep_their_own_message_and_type(tmp_path):
+    async def scenario(bot):
+        author = FakeUser(next_id(), 'suspect')
+        messages = [FakeMessage(next_id(), text, author, bot.main_channel) for text in ('first', 'second')]
+        for message in messages:
+            bot.main_channel.add_message(message)
+        reporters = [(FakeUser(next_id(), f'reporter{i}'), FakeDMChannel(bot.user)) for i in range(2)]
+        # Interleave the two flows step by step
+        for steps in zip(('report', link(bot, messages[0]), 'spam', 'over', 'block'),
+                         ('report', link(bot, messages[1]), 'hate speech/harassment', 'over', 'no block')):
+            for (user, channel), content in zip(reporters, steps):
+                await say(bot, user, channel, content)
+        await bot.outbox.join()
+        return [m.content for m in bot.mod_channel.messages.values()], len(bot.reports)
+
+    posts, open_sessions = run_with_bot(tmp_path, scenario)
+    assert open_sessions == 0
+    assert len(posts) == 2
+    assert any('`first`' in post and '`spam`' in post for post in posts)
+    assert any('`second`' in post and '`hate speech/harassment`' in post for post in posts)
+
+
+def test_cancel_closes_the_session(tmp_path):
+    async def scenario(bot):
+        user, channel = FakeUser(next_id(), 'reporter'), FakeDMChannel(bot.user)
+        await say(bot, user, channel, 'report')
+        await say(bot, user, channel, 'cancel')
+        # Further messages are ignored rather than tripping over the closed session
+        await say(bot, user, channel, 'spam')
+        return channel.replies, user.id in bot.reports
+
+    replies, still_open = run_with_bot(tmp_path, scenario)
+    assert replies[-1] == 'Report cancelled.'
+    assert not still_open
+
+
+def test_sessions_expire_and_are_capped():
+    async def run():
+        sessions = ReportSessions(client=None, max_sessions=2, ttl=60)
+        first = sessions.start(1)
+        assert sessions.start(2) is not None
+        assert sessions.start(3) is None
+        assert sessions.refused == 1
+        # Once the first session has been idle past the TTL it makes room for a new one
+        first.last_active -= 120
+        assert sessions.start(3) is not None
+        assert 1 not in sessions and 2 in sessions and 3 in sessions
+        assert sessions.expired == 1
+        assert sessions.get(3).state == State.REPORT_START
+        await sessions.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,30 @@
+from perspective import REQUESTED_ATTRIBUTES
+from risk import RiskAggregator
+
+
+def scores(**values):
+    return {attr: values.get(attr, 0.0) for attr in REQUESTED_ATTRIBUTES}
+
+
+def test_escalation_lists_only_contributing_messages():
+    risk = RiskAggregator(floor=0.3, escalate_at=1.2, min_messages=3)
+    escalation = None
+    for i in range(12):
+        # Small talk in between the borderline messages 3, 7 and 11
+        toxicity = 0.45 if i % 4 == 3 else 0.0
+        escalation = risk.observe(1, 2, i, scores(TOXICITY=toxicity, PROFANITY=0.35 if i == 3 else 0.0), now=i)
+    assert escalation is not None
+    values, triggered = escalation
+    assert triggered == ['TOXICITY']
+    assert values['TOXICITY'] >= 1.2
+    assert risk.recent_message_ids(1, 2, triggered) == [11, 7, 3]
+
+
+def test_high_risk_from_too_few_messages_does_not_trigger():
+    risk = RiskAggregator(floor=0.3, escalate_at=1.5, min_messages=3)
+    assert risk.observe(1, 2, 1, scores(THREAT=0.9, TOXICITY=0.5), now=0) is None
+    # THREAT is over the line, but on two messages only
+    assert risk.observe(1, 2, 2, scores(THREAT=0.9, TOXICITY=0.5), now=1) is None
+    values, triggered = risk.observe(1, 2, 3, scores(TOXICITY=0.6), now=2)
+    assert values['THREAT'] >= 1.5
+    assert triggered == ['TOXICITY']
@@ -0,0 +1,55 @@
+import asyncio
+from types import SimpleNamespace
+from scheduler import ClassificationScheduler
+
+
+def message(id, content):
+    return SimpleNamespace(id=id, content=content)
+
+
+def test_batch_scores_each_distinct_text_once():
+    calls = []
+    scored = []
+
+    async def score(msg):
+        calls.append(msg.content)
+        return {'TOXICITY': len(msg.content) / 100}
+
+    async def on_scored(msg, scores):
+        scored.append((msg.id, scores['TOXICITY']))
+
+    async def run():
+        scheduler = ClassificationScheduler(score, on_scored, batch_size=8, batch_window=0.05, stats_interval=None)
+        for i, content in enumerate(['spam spam', 'SPAM  spam', 'hello', 'spam spam', 'hello']):
+            await scheduler.submit(message(i, content))
+        await scheduler.queue.join()
+        await scheduler.stop()
+        return scheduler.stats()
+
+    stats = asyncio.run(run())
+    assert sorted(calls) == ['hello', 'spam spam']
+    assert sorted(scored) == [(0, 0.09), (1, 0.09), (2, 0.05), (3, 0.09), (4, 0.05)]
+    assert stats['processed'] == 5
+
+
+def test_stale_messages_are_dropped_unscored(caplog):
+    calls = []
+
+    async def score(msg):
+        calls.append(msg.id)
+        return {}
+
+    async def on_scored(msg, scores):
+        pass
+
+    async def run():
+        scheduler = ClassificationScheduler(score, on_scored, max_wait=0.0, stats_interval=None)
+        await scheduler.submit(message(1, 'too late'))
+        await scheduler.queue.join()
+        await scheduler.stop()
+        return scheduler.stats()
+
+    stats = asyncio.run(run())
+    assert calls == []
+    assert stats['expired'] == 1
+    assert 'dropped it unscored' in caplog.text
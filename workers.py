@@ -0,0 +1,205 @@
+'''
+Classification worker processes for the scaled-out deployment mode. The gateway process (or shard)
+puts channel messages on a local multiprocessing queue; each worker scores them (pre-filter, score
+cache, Perspective) and posts flags straight to the mod channel over Discord's REST API. The scores of
+flagged and borderline messages go back to the gateway, with the new mod post if there is one, so it
+can index flags for reactions and keep its per-author risk windows up to date.
+'''
+import asyncio
+import logging
+import multiprocessing
+import queue
+import aiohttp
+from cache import ScoreCache
+from flagging import flag_post, flagged_attributes
+from perspective import PERSPECTIVE_URL, PerspectiveClient, PerspectiveError
+from prefilter import PreFilter
+from scheduler import TokenBucket
+
+logger = logging.getLogger('discord')
+
+DISCORD_API = 'https://discord.com/api/v10'
+
+
+class Job:
+    '''
+    A channel message to classify. Only plain data, so it pickles cheaply across the process boundary.
+    '''
+    __slots__ = ('message_id', 'channel_id', 'guild_id', 'author_id', 'author_name', 'content', 'mod_channel_id')
+
+    def __init__(self, message_id, channel_id, guild_id, author_id, author_name, content, mod_channel_id):
+        self.message_id = message_id
+        self.channel_id = channel_id
+        self.guild_id = guild_id
+        self.author_id = author_id
+        self.author_name = author_name
+        self.content = content
+        self.mod_channel_id = mod_channel_id
+
+
+class ModChannelPoster:
+    '''
+    Minimal Discord REST client for posting to the mod channel from a worker process.
+    '''
+
+    def __init__(self, token, api=DISCORD_API, max_retries=5):
+        self.token = token
+        self.api = api
+        self.max_retries = max_retries
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(headers={'Authorization': f'Bot {self.token}'})
+        return self._session
+
+    async def send(self, channel_id, content):
+        url = f'{self.api}/channels/{channel_id}/messages'
+        for _ in range(self.max_retries):
+            async with self._get_session().post(url, json={'content': content}) as response:
+                if response.status == 429:
+                    # Respect the channel's rate-limit bucket
+                    retry_after = (await response.json()).get('retry_after', 1.0)
+                    await asyncio.sleep(retry_after)
+                    continue
+                response.raise_for_status()
+                return int((await response.json())['id'])
+        raise RuntimeError(f'Gave up posting to channel {channel_id} after {self.max_retries} rate limits')
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+async def _work(jobs, results, settings):
+    loop = asyncio.get_event_loop()
+    perspective = PerspectiveClient(settings['perspective_key'], url=settings['perspective_url'],
+                                    rate_limiter=TokenBucket(settings['qps']))
+    poster = ModChannelPoster(settings['discord_token'], settings['discord_api'])
+    prefilter = PreFilter()
+    score_cache = ScoreCache()
+    slots = asyncio.Semaphore(settings['max_in_flight'])
+    tasks = set()  # Keeps the in-flight handlers referenced until they finish
+
+    async def handle(job):
+        try:
+            scores = prefilter.classify(job.content)
+            if scores is None:
+                scores = score_cache.get(job.content)
+            if scores is None:
+                scores = await perspective.analyze(job.content)
+                score_cache.put(job.content, scores)
+            mod_message_id = None
+            if flagged_attributes(scores, settings['tox_threshold'], settings['flirt_threshold']):
+                mod_message_id = await poster.send(
+                    job.mod_channel_id, flag_post(job.author_name, job.message_id, job.content, scores))
+            # The gateway needs everything that counts towards an author's risk, not just the flags
+            if mod_message_id is not None or any(value >= settings['risk_floor'] for value in scores.values()):
+                results.put((job, mod_message_id, scores))
+        except (PerspectiveError, aiohttp.ClientError, RuntimeError) as e:
+            logger.error(f'Worker could not classify message {job.message_id}: {e}')
+        except Exception:
+            logger.exception(f'Worker failed handling message {job.message_id}')
+        finally:
+            slots.release()
+
+    try:
+        while True:
+            job = await loop.run_in_executor(None, jobs.get)
+            if job is None:
+                break
+            await slots.acquire()
+            task = asyncio.ensure_future(handle(job))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        # Let the messages already being scored finish
+        for _ in range(settings['max_in_flight']):
+            await slots.acquire()
+    finally:
+        await perspective.close()
+        await poster.close()
+
+
+def worker_main(jobs, results, settings):
+    try:
+        asyncio.run(_work(jobs, results, settings))
+    except KeyboardInterrupt:
+        pass
+
+
+class WorkerPool:
+    '''
+    Runs `size` classification worker processes. `on_scored(job, mod_message_id, scores)` is awaited
+    on the caller's event loop for each message a worker flagged (`mod_message_id` is then the worker's
+    post about it) and for each other message with a score at or above `risk_floor`. `qps` is the
+    Perspective quota of the gateway process that owns the pool (its share of the deployment's quota),
+    split across the workers.
+    '''
+
+    def __init__(self, size, perspective_key, on_scored, perspective_url=PERSPECTIVE_URL, discord_api=DISCORD_API,
+                 qps=1.0, tox_threshold=0.5, flirt_threshold=0.7, risk_floor=0.3, max_in_flight=16, max_queue=10000):
+        self.size = size
+        self.on_scored = on_scored
+        self.settings = {
+            'perspective_key': perspective_key,
+            'perspective_url': perspective_url,
+            'discord_api': discord_api,
+            # The quota is shared, so each worker gets its slice of it
+            'qps': qps / size,
+            'tox_threshold': tox_threshold,
+            'flirt_threshold': flirt_threshold,
+            'risk_floor': risk_floor,
+            'max_in_flight': max_in_flight,
+        }
+        context = multiprocessing.get_context('spawn')
+        self.context = context
+        self.jobs = context.Queue(max_queue)
+        self.results = context.Queue()
+        self.processes = []
+        self._results_task = None
+
+    def start(self, discord_token):
+        if self.processes:
+            return
+        settings = dict(self.settings, discord_token=discord_token)
+        for i in range(self.size):
+            process = self.context.Process(target=worker_main, args=(self.jobs, self.results, settings),
+                                           name=f'classifier-{i}', daemon=True)
+            process.start()
+            self.processes.append(process)
+        self._results_task = asyncio.ensure_future(self._collect())
+
+    def submit(self, message, mod_channel_id):
+        '''
+        Queues a channel message for classification. Returns False if the queue is full.
+        '''
+        job = Job(message.id, message.channel.id, message.guild.id, message.author.id,
+                  message.author.name, message.content, mod_channel_id)
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            return False
+        return True
+
+    async def _collect(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            result = await loop.run_in_executor(None, self.results.get)
+            if result is None:
+                break
+            try:
+                await self.on_scored(*result)
+            except Exception:
+                logger.exception('Handling scores from a worker failed')
+
+    async def stop(self):
+        loop = asyncio.get_event_loop()
+        for _ in self.processes:
+            self.jobs.put(None)
+        for process in self.processes:
+            await loop.run_in_executor(None, process.join, 10)
+        self.processes = []
+        if self._results_task is not None:
+            self.results.put(None)
+            await self._results_task
+            self._results_task = None